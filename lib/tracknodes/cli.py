@@ -1,6 +1,7 @@
 """ Command Line Interface Module """
+from __future__ import absolute_import
 
-from tracknodes import TrackNodes
+from tracknodes.tracknodes import TrackNodes
 
 
 class Cli(object):
@@ -2,21 +2,123 @@
 
 import sqlite3 as lite
 from subprocess import Popen, PIPE
+import calendar
+import contextlib
+import csv
 import errno
+import fcntl
+import fnmatch
+import itertools
+import json
 import re
 import optparse
 import os
-import yaml
+import signal
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+# Current version of the database schema, see TrackNodes.migrate_db()
+SCHEMA_VERSION = 17
+
+# Number of history rows fetched from sqlite at a time when streaming results
+HISTORY_BATCH_SIZE = 1000
+
+# Days covered by --report when --since is not given
+REPORT_DAYS = 30
+
+# Pages released by PRAGMA incremental_vacuum after each compaction, bounds the time an update spends vacuuming
+COMPACT_VACUUM_PAGES = 2048
+
+# Number of recurring offenders shown by --report when --limit is not given
+REPORT_OFFENDERS = 10
+
+# Seconds between snapshots of the failed nodes, bounds the history replayed by --at
+CHECKPOINT_INTERVAL = 6 * 3600
+
+# Default seconds to wait for another connection to release a lock on the database
+BUSY_TIMEOUT = 30
+
+# Default seconds the nodes command may run before it is killed, 0 disables the timeout
+NODES_CMD_TIMEOUT = 60
+
+# Bits of the encoded node state, 0 is online
+STATE_BITS = [("offline", 1), ("down", 2), ("reserve", 4), ("job-exclusive", 8), ("job-sharing", 16), ("busy", 32),
+              ("time-shared", 64), ("state-unknown", 128), ("undetected-state", 1024)]
+STATE_TOKENS = dict(STATE_BITS)
+# PBSpro states of pbsnodes -av mapped to the bits of the closest state
+STATE_TOKENS.update({"job-busy": 32, "resv-exclusive": 4, "provisioning": 32, "wait-provisioning": 32, "maintenance": 1,
+                     "sleep": 1, "stale": 128, "unresolvable": 128, "initializing": 128})
+
+# States with any of these bits are failed, nodes in other states are up, such as free or job-exclusive
+FAILED_STATES = 1 | 2 | 128 | 1024
+
+# slurm states of sinfo -N mapped to the state bits, unknown states are undetected-state
+SLURM_STATES = {"idle": 0, "allocated": 8, "mixed": 16, "completing": 32, "reserved": 4, "maint": 4, "planned": 4, "blocked": 4,
+                "down": 2, "fail": 2, "failing": 2, "drained": 1, "drain": 1, "draining": 1 | 8, "unknown": 128, "future": 128,
+                "inval": 128, "not_responding": 128, "no_respond": 128, "cloud": 0, "power_down": 0, "powered_down": 0,
+                "powering_down": 0, "powering_up": 32, "reboot_requested": 0, "reboot_issued": 32, "perfctrs": 0}
+
+# Characters read at a time from structured output such as pbsnodes -F json
+JSON_CHUNK_SIZE = 65536
+
+# Separator of a key and its value in a JSON object
+JSON_COLON_RE = re.compile(r'\s*:\s*')
+
+# Text of every valid combination of state bits, so decoding is a lookup
+STATE_NAMES = dict((sum(bit for (i, (name, bit)) in enumerate(STATE_BITS) if combination >> i & 1),
+                    ",".join(name for (i, (name, bit)) in enumerate(STATE_BITS) if combination >> i & 1))
+                   for combination in range(1, 1 << len(STATE_BITS)))
+STATE_NAMES[0] = "online"
+
+# Separators of the states in a state string, such as "down,offline"
+STATE_SPLIT_RE = re.compile(r'[,\s]+')
+
+# sinfo -dR output, "REASON USER TIMESTAMP NODELIST", the nodelist is a hostlist such as r1n[001-480,512]
+SINFO_LINE_RE = re.compile(r'^(.*?)\s+([a-zA-Z0-9\-_]+)\s+([0-9\-:T]+)\s+([a-zA-Z0-9_\-\[\],]+)$')
+
+
+class NodesCmdTimeout(Exception):
+    """ The nodes command did not finish within the timeout """
+    pass
+
+
+class NodesCmdError(Exception):
+    """ The nodes command exited with an error, its output is incomplete """
+    pass
 
 
 class TrackNodes:
     """ TrackNodes Interface """
-    def __init__(self, update=False, dbfile=None, nodes_cmd=None, verbose=False):
+    # State strings seen by encode_state and encode_slurm_state and their encoded state
+    encoded_states = {}
+    encoded_slurm_states = {}
+
+    def __init__(self, update=False, dbfile=None, nodes_cmd=None, verbose=False,
+                 node=None, since=None, until=None, state=None, limit=None,
+                 daemon=False, interval=60, timeout=None, cluster=None, downtime=False, report=False, search=None,
+                 retention=None, archive=False, busy_timeout=None, metrics=None, metrics_format=None, changes=None,
+                 export=None, current=False, at=None, debounce=None, flaps=False, full=None,
+                 summary=False, wal=None):
         """
         Create initial sqlite database and initialize connection
         """
         self.cur = None
         self.con = None
+        self.busy_timeout = busy_timeout
+        # Write-ahead logging, queries then need write access to the directory of the database
+        self.wal = wal
+        # Held while updating, so overlapping updates of the same database skip instead of contending
+        self.update_lock = None
+
+        # Seconds spent in each phase and counts of the update cycle, written to the metrics file
+        self.phase_seconds = {}
+        self.counts = {}
+        self.metrics = metrics
+        # json or prometheus, by default prometheus for files ending in .prom
+        self.metrics_format = metrics_format
         self.current_failed = []
 
         self.update = update
@@ -24,6 +126,60 @@ class TrackNodes:
         self.nodes_cmd = TrackNodes.which(nodes_cmd)
         self.verbose = verbose
         self.resourcemanager = None
+        self.timeout = timeout
+
+        # Name of the cluster rows are recorded for and history is filtered by, None is the default cluster ''
+        self.cluster = cluster
+        # TrackNodes instances collecting the clusters listed in the config file
+        self.clusters = []
+        self.shared_con = False
+
+        # History filters
+        self.node = node
+        self.since = since
+        self.until = until
+        self.state = state
+        self.limit = limit
+        # Show downtime intervals instead of history
+        self.downtime = downtime
+        # Show an availability report instead of history
+        self.report = report
+        # Search comments instead of showing history
+        self.search = search
+        # Months of history kept in NodeStates, older history is moved to NodeStatesArchive, None keeps everything
+        self.retention = retention
+        # Include archived history in queries
+        self.archive = archive
+        # Show the changes recorded after this cursor, a NodeStates id or a time
+        self.changes = changes
+        # Export the history, or with current the currently failed nodes, as csv or jsonl
+        self.export = export
+        self.current = current
+        # Show the nodes that were failed at this time
+        self.at = at
+        # Cycles a change of a node must persist before it is recorded, None or 0 records changes immediately
+        self.debounce = debounce
+        # Time each change recorded by this update was first seen, changes not in it are recorded at the current time
+        self.change_times = {}
+        # Show flaps instead of the history
+        self.flaps = flaps
+
+        # Track the state of every node from structured output, not only of the failed nodes
+        self.full = full
+        # With full, {nodename: state} of the nodes that are up in the current output
+        self.current_activity = None
+        # With full, last known {nodename: state} of up nodes not free, loaded once and kept between daemon updates
+        self.activity = None
+
+        # Show the cached summary of the failed nodes instead of the history
+        self.summary = summary
+        # Nodes online_nodes recorded, with the state of the node when full
+        self.onlined_nodes = []
+
+        # Daemon mode, update every interval seconds until SIGTERM or SIGINT
+        self.daemon = daemon
+        self.interval = interval
+        self.running = False
 
     def parse_args(self):
         """ Setup Arguments and Options for CLI """
@@ -46,18 +202,164 @@ class TrackNodes:
                           metavar="VERBOSE",
                           action="store_true",
                           default=False)
+        parser.add_option("-n", "--node", dest="node",
+                          help="Only show history of nodes matching name or glob, example: n101, r1n*",
+                          metavar="NODE",
+                          default=None)
+        parser.add_option("--since", dest="since",
+                          help="Only show history at or after time, example: 2016-11-28, '2016-11-28 20:30:00'",
+                          metavar="SINCE",
+                          default=None)
+        parser.add_option("--until", dest="until",
+                          help="Only show history before time, example: 2016-11-29, '2016-11-28 21:00:00'",
+                          metavar="UNTIL",
+                          default=None)
+        parser.add_option("-s", "--state", dest="state",
+                          help="Only show history with any of the states, example: online, down,state-unknown",
+                          metavar="STATE",
+                          default=None)
+        parser.add_option("-l", "--limit", dest="limit",
+                          help="Only show the most recent LIMIT history entries",
+                          metavar="LIMIT",
+                          type="int",
+                          default=None)
+        parser.add_option("-D", "--daemon", dest="daemon",
+                          help="Keep running and update the database every INTERVAL seconds",
+                          metavar="DAEMON",
+                          action="store_true",
+                          default=False)
+        parser.add_option("-i", "--interval", dest="interval",
+                          help="Seconds between updates in daemon mode, default 60",
+                          metavar="INTERVAL",
+                          type="float",
+                          default=60)
+        parser.add_option("-t", "--timeout", dest="timeout",
+                          help="Seconds the command to show node state may run before the update is failed, default %d" % NODES_CMD_TIMEOUT,
+                          metavar="TIMEOUT",
+                          type="float",
+                          default=None)
+        parser.add_option("-C", "--cluster", dest="cluster",
+                          help="Cluster to record node states for, or to show history of",
+                          metavar="CLUSTER",
+                          default=None)
+        parser.add_option("-d", "--downtime", dest="downtime",
+                          help="Show downtime of nodes instead of the history",
+                          metavar="DOWNTIME",
+                          action="store_true",
+                          default=False)
+        parser.add_option("-r", "--report", dest="report",
+                          help="Show availability, MTBF, MTTR and recurring offenders, default is the last %d days" % REPORT_DAYS,
+                          metavar="REPORT",
+                          action="store_true",
+                          default=False)
+        parser.add_option("-S", "--search", dest="search",
+                          help="Search comments for words, nodes with the most relevant matches first, example: DIMM, 'power fault'",
+                          metavar="SEARCH",
+                          default=None)
+        parser.add_option("-R", "--retention", dest="retention",
+                          help="Months of history to keep when updating, older history is compressed into monthly archives",
+                          metavar="RETENTION",
+                          type="int",
+                          default=None)
+        parser.add_option("-A", "--archive", dest="archive",
+                          help="Include archived history",
+                          metavar="ARCHIVE",
+                          action="store_true",
+                          default=False)
+        parser.add_option("-F", "--changes", dest="changes",
+                          help="Show changes recorded after a cursor printed by a previous --changes, or after a time, example: 0, 2016-11-28",
+                          metavar="CURSOR",
+                          default=None)
+        parser.add_option("-E", "--export", dest="export",
+                          help="Export the history as csv or jsonl, filtered like the history",
+                          metavar="FORMAT",
+                          type="choice",
+                          choices=["csv", "jsonl"],
+                          default=None)
+        parser.add_option("--current", dest="current",
+                          help="Export the currently failed nodes instead of the history",
+                          action="store_true",
+                          default=False)
+        parser.add_option("--at", dest="at",
+                          help="Show the nodes that were failed at a time, example: '2016-11-28 21:00:00'",
+                          metavar="AT",
+                          default=None)
+        parser.add_option("--debounce", dest="debounce",
+                          help="Updates a change of a node must persist for before it is recorded, changes reverted sooner are recorded as flaps, default 0",
+                          metavar="DEBOUNCE",
+                          type="int",
+                          default=None)
+        parser.add_option("--flaps", dest="flaps",
+                          help="Show nodes whose changes reverted within the debounce window instead of the history",
+                          action="store_true",
+                          default=False)
+        parser.add_option("--summary", dest="summary",
+                          help="Show the failed nodes, since when and their failures this month from the summary cache",
+                          action="store_true",
+                          default=False)
+        parser.add_option("--full", dest="full",
+                          help="Record changes of every node state, such as job-exclusive, from pbsnodes -av -F json (PBSpro) or sinfo -N (slurm)",
+                          action="store_true",
+                          default=None)
+        parser.add_option("--wal", dest="wal",
+                          help="Use write-ahead logging so queries and updates do not wait on each other, users querying need write access to the database directory",
+                          action="store_true",
+                          default=None)
+        parser.add_option("-B", "--busy-timeout", dest="busy_timeout",
+                          help="Seconds to wait for the database when it is locked by another update, default %d" % BUSY_TIMEOUT,
+                          metavar="BUSY_TIMEOUT",
+                          type="float",
+                          default=None)
+        parser.add_option("-M", "--metrics", dest="metrics",
+                          help="Write timings and counts of each update to a file, as JSON or for the Prometheus node exporter if named *.prom",
+                          metavar="METRICS",
+                          default=None)
+        parser.add_option("--metrics-format", dest="metrics_format",
+                          help="Format of the metrics file, json or prometheus",
+                          metavar="METRICS_FORMAT",
+                          type="choice",
+                          choices=["json", "prometheus"],
+                          default=None)
         (options, args) = parser.parse_args()
         self.update = options.update
         self.nodes_cmd = options.cmd
         self.dbfile = options.dbfile
         self.verbose = options.verbose
+        self.node = options.node
+        self.since = options.since
+        self.until = options.until
+        self.state = options.state
+        self.limit = options.limit
+        self.daemon = options.daemon
+        self.interval = options.interval
+        self.timeout = options.timeout
+        self.cluster = options.cluster
+        self.downtime = options.downtime
+        self.report = options.report
+        self.search = options.search
+        self.retention = options.retention
+        self.archive = options.archive
+        self.changes = options.changes
+        self.export = options.export
+        self.current = options.current
+        self.at = options.at
+        self.debounce = options.debounce
+        self.flaps = options.flaps
+        self.full = options.full
+        self.summary = options.summary
+        self.busy_timeout = options.busy_timeout
+        self.wal = options.wal
+        self.metrics = options.metrics
+        self.metrics_format = options.metrics_format
 
     def parse_configfile(self, configs=['/etc/tracknodes.conf']):
         # Load Configurations if not set on CLI
         for configfile in configs:
             if os.path.isfile(configfile):
+                # Only pay for importing yaml when there is a config file to read
+                import yaml
                 with open(configfile, 'r') as f:
-                    tracknodes_conf = yaml.load(f)
+                    tracknodes_conf = yaml.safe_load(f)
                     if tracknodes_conf is not None:
                         if "dbfile" in tracknodes_conf:
                             if self.dbfile is None:
@@ -65,6 +367,59 @@ class TrackNodes:
                         if "cmd" in tracknodes_conf:
                             if self.nodes_cmd is None:
                                 self.nodes_cmd = str(tracknodes_conf["cmd"])
+                        if "timeout" in tracknodes_conf:
+                            if self.timeout is None:
+                                self.timeout = float(tracknodes_conf["timeout"])
+                        if "busy_timeout" in tracknodes_conf:
+                            if self.busy_timeout is None:
+                                self.busy_timeout = float(tracknodes_conf["busy_timeout"])
+                        if "wal" in tracknodes_conf:
+                            if self.wal is None:
+                                self.wal = bool(tracknodes_conf["wal"])
+                        if "metrics" in tracknodes_conf:
+                            if self.metrics is None:
+                                self.metrics = str(tracknodes_conf["metrics"])
+                        if "metrics_format" in tracknodes_conf:
+                            if self.metrics_format is None:
+                                self.metrics_format = str(tracknodes_conf["metrics_format"])
+                        if "retention" in tracknodes_conf:
+                            if self.retention is None:
+                                self.retention = int(tracknodes_conf["retention"])
+                        if "debounce" in tracknodes_conf:
+                            if self.debounce is None:
+                                self.debounce = int(tracknodes_conf["debounce"])
+                        if "full" in tracknodes_conf:
+                            if self.full is None:
+                                self.full = bool(tracknodes_conf["full"])
+                        if "clusters" in tracknodes_conf:
+                            # Clusters given on the CLI override the config file
+                            if self.nodes_cmd is None and self.cluster is None:
+                                self.clusters = [self.cluster_collector(cluster_conf) for cluster_conf in tracknodes_conf["clusters"]]
+
+    def cluster_collector(self, cluster_conf):
+        """
+        Create a TrackNodes instance collecting a cluster from the config file, example: {"name": "eagle", "cmd": "/opt/pbsnodes"}
+        """
+        if "name" not in cluster_conf:
+            raise Exception("Cluster in config file is missing a name: %s" % cluster_conf)
+        collector = TrackNodes(verbose=self.verbose, cluster=str(cluster_conf["name"]))
+        if "cmd" in cluster_conf:
+            collector.nodes_cmd = str(cluster_conf["cmd"])
+        if "timeout" in cluster_conf:
+            collector.timeout = float(cluster_conf["timeout"])
+        else:
+            collector.timeout = self.timeout
+        if "full" in cluster_conf:
+            collector.full = bool(cluster_conf["full"])
+        return collector
+
+    def share_db(self, collector):
+        """
+        Let a cluster collector use this database connection, only from the thread that owns the connection
+        """
+        collector.con = self.con
+        collector.cur = self.con.cursor()
+        collector.shared_con = True
 
     def find_nodes_cmd(self):
         """
@@ -90,89 +445,703 @@ class TrackNodes:
         if self.verbose:
             print("cmd: %s" % self.nodes_cmd)
 
-    def connect_db(self):
+    def find_clusters_cmds(self):
+        """
+        Search for nodes command of this cluster or of each of the clusters from the config file
+        """
+        if not self.clusters:
+            with self.timed_phase("find_nodes_cmd"):
+                self.find_nodes_cmd()
+            return
+        for collector in self.clusters:
+            # Settings of the update not given for the cluster
+            if collector.full is None:
+                collector.full = self.full
+            collector.debounce = self.debounce
+            # Detection is cached in the database, so it runs in this thread
+            self.share_db(collector)
+            with collector.timed_phase("find_nodes_cmd"):
+                collector.find_nodes_cmd()
+
+    def find_dbfile(self):
+        """
+        Default to the database in the home directory if no dbfile was given
+        """
         if self.dbfile is None:
             self.dbfile = os.path.expanduser("~/.tracknodes.db")
+        return self.dbfile
+
+    def connect_db(self, readonly=False):
+        """
+        Connect to the database, creating or migrating it if needed
+        A readonly connection never writes to the database, queries of a database that does not exist yet see an empty history
+        """
+        self.find_dbfile()
 
-        if (False == os.path.isfile(self.dbfile)):
-            firstrun = True
-        else:
-            firstrun = False
         if self.verbose:
             print("dbfile: %s" % self.dbfile)
 
-        self.con = lite.connect(self.dbfile)
+        busy_timeout = self.busy_timeout
+        if busy_timeout is None:
+            busy_timeout = BUSY_TIMEOUT
 
-        with self.con:
+        if readonly:
+            # Only the update creates and migrates the database, holding the update lock
+            if not os.path.isfile(self.dbfile):
+                self.con = lite.connect(":memory:")
+                self.cur = self.con.cursor()
+                self.migrate_db()
+                return
+            self.con = TrackNodes.connect_readonly(self.dbfile, busy_timeout)
             self.cur = self.con.cursor()
-            if (True == firstrun):
-                self.cur.execute("CREATE TABLE CurrentFailedNodes(Name TEXT, State INT, Comment TEXT)")
-                # Use ISO8601 for storing time
-                self.cur.execute("CREATE TABLE NodeStates(Name TEXT, State INT, Comment TEXT, Time TEXT)")
-                self.con.commit()
+            version = self.schema_version()
+            if version != SCHEMA_VERSION:
+                raise Exception("Database schema version %d of dbfile: %s is not the supported version %d, run tracknodes --update to upgrade it" %
+                                (version, self.dbfile, SCHEMA_VERSION))
+            return
+
+        self.con = lite.connect(self.dbfile, timeout=busy_timeout)
+        self.cur = self.con.cursor()
+        self.migrate_db()
+        # WAL is opt-in, in rollback journal mode users without write access to the directory can still query
+        journal_mode = "wal" if self.wal else "delete"
+        self.cur.execute("PRAGMA journal_mode")
+        if self.cur.fetchone()[0] != journal_mode:
+            self.cur.execute("PRAGMA journal_mode=%s" % journal_mode)
+            self.cur.fetchall()
+
+    @staticmethod
+    def connect_readonly(dbfile, busy_timeout=BUSY_TIMEOUT):
+        """
+        Open a sqlite database read-only through a sqlite URI
+        """
+        path = os.path.abspath(dbfile).replace("%", "%25").replace("?", "%3f").replace("#", "%23")
+        try:
+            return lite.connect("file:%s?mode=ro" % path, timeout=busy_timeout, uri=True)
+        except TypeError:
+            # sqlite URIs are not supported by python2, fall back to a regular connection
+            return lite.connect(dbfile, timeout=busy_timeout)
+
+    def lock_updates(self):
+        """
+        Take the exclusive update lock of the database, a lock file next to it
+        Returns False if another update or daemon holds the lock
+        """
+        if self.update_lock is not None:
+            return True
+        lockfile = open(self.find_dbfile() + ".lock", "a")
+        try:
+            fcntl.flock(lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            lockfile.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self.update_lock = lockfile
+        return True
+
+    def unlock_updates(self):
+        """
+        Release the update lock
+        """
+        if self.update_lock is not None:
+            self.update_lock.close()
+            self.update_lock = None
+
+    def schema_version(self):
+        """
+        Return the schema version of the database, 0 if it is empty
+        """
+        self.cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        tables = set(row[0] for row in self.cur)
+        if "SchemaVersion" in tables:
+            self.cur.execute("SELECT MAX(Version) FROM SchemaVersion")
+            return self.cur.fetchone()[0] or 0
+        elif "NodeStates" in tables:
+            # Databases created before versioning was added
+            return 1
+        return 0
+
+    def migrate_db(self):
+        """
+        Upgrade the database schema one version at a time using the migrate_<version> methods
+        All migrations run in one transaction, a failed upgrade leaves the database at the version it had
+        """
+        version = self.schema_version()
+        if version == SCHEMA_VERSION:
+            return
+        if version > SCHEMA_VERSION:
+            raise Exception("Database schema version %d of dbfile: %s is newer than supported version %d" % (version, self.dbfile, SCHEMA_VERSION))
+
+        if version == 0:
+            # Must be set before the first table is created, lets compaction release pages without a full VACUUM
+            self.cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+        # sqlite3 commits DDL outside of a transaction it opened, so the transaction is managed here
+        isolation_level = self.con.isolation_level
+        self.con.isolation_level = None
+        try:
+            self.cur.execute("BEGIN IMMEDIATE")
+            try:
+                # Another process may have upgraded the database while this one waited for the write lock
+                version = self.schema_version()
+                for next_version in range(version + 1, SCHEMA_VERSION + 1):
+                    if self.verbose:
+                        print("Migrating database schema to version %d" % next_version)
+                    getattr(self, "migrate_%d" % next_version)()
+                    self.cur.execute("CREATE TABLE IF NOT EXISTS SchemaVersion(Version INT)")
+                    self.cur.execute("INSERT INTO SchemaVersion VALUES(?)", (next_version,))
+            except:
+                self.cur.execute("ROLLBACK")
+                raise
+            self.cur.execute("COMMIT")
+        finally:
+            self.con.isolation_level = isolation_level
+
+    def migrate_1(self):
+        """
+        Initial schema, time stored as ISO8601 text
+        """
+        self.cur.execute("CREATE TABLE CurrentFailedNodes(Name TEXT, State INT, Comment TEXT)")
+        self.cur.execute("CREATE TABLE NodeStates(Name TEXT, State INT, Comment TEXT, Time TEXT)")
+
+    def migrate_2(self):
+        """
+        Store time as integer seconds since the epoch and index history by time and by node
+        """
+        self.cur.execute("CREATE TABLE NodeStatesEpoch(Name TEXT, State INT, Comment TEXT, Time INTEGER)")
+        self.cur.execute("INSERT INTO NodeStatesEpoch SELECT Name, State, Comment, CAST(strftime('%s', Time) AS INTEGER) FROM NodeStates ORDER BY datetime(Time)")
+        self.cur.execute("DROP TABLE NodeStates")
+        self.cur.execute("ALTER TABLE NodeStatesEpoch RENAME TO NodeStates")
+        self.cur.execute("CREATE INDEX NodeStatesTime ON NodeStates(Time)")
+        self.cur.execute("CREATE INDEX NodeStatesNameTime ON NodeStates(Name, Time)")
+        # Updates and deletes of failed nodes are keyed by name
+        self.cur.execute("CREATE INDEX IF NOT EXISTS CurrentFailedNodesName ON CurrentFailedNodes(Name)")
+
+    def migrate_3(self):
+        """
+        Key value store for state that persists between runs, such as the detected resource manager
+        """
+        self.cur.execute("CREATE TABLE Metadata(Key TEXT PRIMARY KEY, Value TEXT)")
+
+    def migrate_4(self):
+        """
+        Record update cycles that failed, such as the nodes command timing out
+        """
+        self.cur.execute("CREATE TABLE FailedUpdates(Time INTEGER, Reason TEXT)")
+
+    def migrate_5(self):
+        """
+        Record which cluster node states belong to, the default cluster is ''
+        """
+        for table in ["NodeStates", "CurrentFailedNodes", "FailedUpdates"]:
+            self.cur.execute("ALTER TABLE %s ADD COLUMN Cluster TEXT NOT NULL DEFAULT ''" % table)
+        self.cur.execute("CREATE INDEX NodeStatesClusterTime ON NodeStates(Cluster, Time)")
+        self.cur.execute("DROP INDEX CurrentFailedNodesName")
+        self.cur.execute("CREATE INDEX CurrentFailedNodesClusterName ON CurrentFailedNodes(Cluster, Name)")
+
+    def migrate_6(self):
+        """
+        Downtime intervals, one row per outage of a node, End is NULL while the node is still failed
+        """
+        self.cur.execute("CREATE TABLE Downtimes(Cluster TEXT NOT NULL DEFAULT '', Name TEXT, State INT, Comment TEXT, Start INTEGER, End INTEGER)")
+        self.cur.execute("CREATE INDEX DowntimesStart ON Downtimes(Start)")
+        self.cur.execute("CREATE INDEX DowntimesNameStart ON Downtimes(Name, Start)")
+        self.cur.execute("CREATE INDEX DowntimesClusterNameEnd ON Downtimes(Cluster, Name, End)")
+
+        # Backfill from the existing history, pairing each failure with the next online of the node
+        cur = self.con.cursor()
+        cur.execute("SELECT Cluster, Name, State, Comment, Time FROM NodeStates ORDER BY Cluster, Name, Time")
+        downtimes = []
+        opened = None
+        for (cluster, nodename, state, comment, nodetime) in cur:
+            if opened is not None and (opened[0] != cluster or opened[1] != nodename):
+                # Still failed at the end of the history of the node
+                downtimes.append(opened)
+                opened = None
+            if state == 0:
+                if opened is not None:
+                    downtimes.append(opened[0:5] + [nodetime])
+                    opened = None
+            elif opened is None:
+                opened = [cluster, nodename, state, comment, nodetime, None]
+            else:
+                opened[2:4] = [state, comment]
+
+            if len(downtimes) >= HISTORY_BATCH_SIZE:
+                self.cur.executemany("INSERT INTO Downtimes VALUES(?, ?, ?, ?, ?, ?)", downtimes)
+                downtimes = []
+        if opened is not None:
+            downtimes.append(opened)
+        self.cur.executemany("INSERT INTO Downtimes VALUES(?, ?, ?, ?, ?, ?)", downtimes)
+        cur.close()
+
+    def migrate_7(self):
+        """
+        Covering index for reports, aggregating downtime by node and state reads only the index in order
+        """
+        self.cur.execute("CREATE INDEX DowntimesReport ON Downtimes(Cluster, Name, State, Start, End)")
+
+    def migrate_8(self):
+        """
+        Full text index of comments, kept in sync with NodeStates by triggers
+        NodeStates gets an INTEGER PRIMARY KEY so the rowids the index refers to are never renumbered by VACUUM
+        """
+        self.cur.execute("CREATE TABLE NodeStatesId(Id INTEGER PRIMARY KEY, Name TEXT, State INT, Comment TEXT, Time INTEGER, Cluster TEXT NOT NULL DEFAULT '')")
+        self.cur.execute("INSERT INTO NodeStatesId SELECT rowid, Name, State, Comment, Time, Cluster FROM NodeStates ORDER BY rowid")
+        self.cur.execute("DROP TABLE NodeStates")
+        self.cur.execute("ALTER TABLE NodeStatesId RENAME TO NodeStates")
+        self.cur.execute("CREATE INDEX NodeStatesTime ON NodeStates(Time)")
+        self.cur.execute("CREATE INDEX NodeStatesNameTime ON NodeStates(Name, Time)")
+        self.cur.execute("CREATE INDEX NodeStatesClusterTime ON NodeStates(Cluster, Time)")
+
+        try:
+            self.cur.execute("CREATE VIRTUAL TABLE NodeComments USING fts5(Comment, content='NodeStates', content_rowid='Id')")
+        except lite.OperationalError:
+            # sqlite was built without FTS5, searches fall back to scanning comments
+            if self.verbose:
+                print("sqlite does not support FTS5, comments are not indexed")
+            return
+        self.cur.execute("INSERT INTO NodeComments(rowid, Comment) SELECT Id, Comment FROM NodeStates WHERE Comment!=''")
+        self.cur.execute("CREATE TRIGGER NodeCommentsInsert AFTER INSERT ON NodeStates WHEN new.Comment!='' BEGIN "
+                         "INSERT INTO NodeComments(rowid, Comment) VALUES(new.Id, new.Comment); END")
+        self.cur.execute("CREATE TRIGGER NodeCommentsDelete AFTER DELETE ON NodeStates WHEN old.Comment!='' BEGIN "
+                         "INSERT INTO NodeComments(NodeComments, rowid, Comment) VALUES('delete', old.Id, old.Comment); END")
+
+    def migrate_9(self):
+        """
+        Monthly archives of history older than the retention, Data is zlib compressed JSON rows ordered by time
+        """
+        self.cur.execute("CREATE TABLE NodeStatesArchive(Month TEXT PRIMARY KEY, Start INTEGER, End INTEGER, Rows INTEGER, Data BLOB)")
+
+    def migrate_10(self):
+        """
+        Snapshots of CurrentFailedNodes, Data is zlib compressed JSON rows of the failed nodes after the changes up to LastId
+        """
+        self.cur.execute("CREATE TABLE FailedNodesCheckpoints(Time INTEGER PRIMARY KEY, LastId INTEGER, Rows INTEGER, Data BLOB)")
+
+    def migrate_11(self):
+        """
+        Intern node names and comments into the Nodes and Comments tables, the history in NodeStatesData refers to them by id
+        NodeStates becomes a view joining them back, rows inserted into the view are interned by a trigger
+        The full text index moves to Comments, so each distinct comment is indexed once
+        """
+        self.cur.execute("DROP TRIGGER IF EXISTS NodeCommentsInsert")
+        self.cur.execute("DROP TRIGGER IF EXISTS NodeCommentsDelete")
+        self.cur.execute("DROP TABLE IF EXISTS NodeComments")
+
+        self.cur.execute("CREATE TABLE Nodes(Id INTEGER PRIMARY KEY, Name TEXT NOT NULL UNIQUE)")
+        self.cur.execute("CREATE TABLE Comments(Id INTEGER PRIMARY KEY, Comment TEXT NOT NULL UNIQUE)")
+        self.cur.execute("INSERT INTO Nodes(Name) SELECT DISTINCT Name FROM NodeStates ORDER BY Name")
+        self.cur.execute("INSERT INTO Comments(Comment) SELECT DISTINCT coalesce(Comment, '') FROM NodeStates")
+        self.cur.execute("CREATE TABLE NodeStatesData(Id INTEGER PRIMARY KEY, NodeId INTEGER NOT NULL, State INT, CommentId INTEGER NOT NULL,"
+                         " Time INTEGER, Cluster TEXT NOT NULL DEFAULT '')")
+        self.cur.execute("INSERT INTO NodeStatesData SELECT s.Id, n.Id, s.State, c.Id, s.Time, s.Cluster FROM NodeStates s"
+                         " JOIN Nodes n ON n.Name=s.Name JOIN Comments c ON c.Comment=coalesce(s.Comment, '') ORDER BY s.Id")
+        self.cur.execute("DROP TABLE NodeStates")
+        self.cur.execute("CREATE INDEX NodeStatesDataTime ON NodeStatesData(Time)")
+        self.cur.execute("CREATE INDEX NodeStatesDataNodeTime ON NodeStatesData(NodeId, Time)")
+        self.cur.execute("CREATE INDEX NodeStatesDataClusterTime ON NodeStatesData(Cluster, Time)")
+        self.cur.execute("CREATE INDEX NodeStatesDataComment ON NodeStatesData(CommentId)")
+
+        self.create_node_states_view()
+
+        try:
+            self.cur.execute("CREATE VIRTUAL TABLE NodeComments USING fts5(Comment, content='Comments', content_rowid='Id')")
+        except lite.OperationalError:
+            # sqlite was built without FTS5, searches fall back to scanning comments
+            if self.verbose:
+                print("sqlite does not support FTS5, comments are not indexed")
+            return
+        self.cur.execute("INSERT INTO NodeComments(NodeComments) VALUES('rebuild')")
+        self.cur.execute("CREATE TRIGGER NodeCommentsInsert AFTER INSERT ON Comments BEGIN "
+                         "INSERT INTO NodeComments(rowid, Comment) VALUES(new.Id, new.Comment); END")
+        self.cur.execute("CREATE TRIGGER NodeCommentsDelete AFTER DELETE ON Comments BEGIN "
+                         "INSERT INTO NodeComments(NodeComments, rowid, Comment) VALUES('delete', old.Id, old.Comment); END")
+
+    def create_node_states_view(self):
+        """
+        Create the NodeStates view of the interned history and its triggers interning rows inserted into it
+        """
+        # LEFT JOINs on the primary keys are dropped by sqlite when a query does not use the name or comment
+        self.cur.execute("CREATE VIEW NodeStates AS SELECT s.Id AS Id, n.Name AS Name, s.State AS State, c.Comment AS Comment, s.Time AS Time,"
+                         " s.Cluster AS Cluster, s.NodeId AS NodeId, s.CommentId AS CommentId FROM NodeStatesData s"
+                         " LEFT JOIN Nodes n ON n.Id=s.NodeId LEFT JOIN Comments c ON c.Id=s.CommentId")
+        self.cur.execute("CREATE TRIGGER NodeStatesInsert INSTEAD OF INSERT ON NodeStates BEGIN "
+                         "INSERT OR IGNORE INTO Nodes(Name) VALUES(new.Name); "
+                         "INSERT OR IGNORE INTO Comments(Comment) VALUES(coalesce(new.Comment, '')); "
+                         "INSERT INTO NodeStatesData(Id, NodeId, State, CommentId, Time, Cluster) VALUES(new.Id, "
+                         "(SELECT Id FROM Nodes WHERE Name=new.Name), new.State, "
+                         "(SELECT Id FROM Comments WHERE Comment=coalesce(new.Comment, '')), new.Time, coalesce(new.Cluster, '')); END")
+        self.cur.execute("CREATE TRIGGER NodeStatesDelete INSTEAD OF DELETE ON NodeStates BEGIN "
+                         "DELETE FROM NodeStatesData WHERE Id=old.Id; END")
+
+    def migrate_12(self):
+        """
+        Changes held back by the debounce window, and flaps, changes that reverted within the window
+        A flap record is open, End is NULL, until the node has been quiet for more than the window
+        """
+        self.cur.execute("CREATE TABLE PendingChanges(Cluster TEXT NOT NULL DEFAULT '', Name TEXT, State INT, Comment TEXT, Since INTEGER, Cycles INT,"
+                         " PRIMARY KEY(Cluster, Name))")
+        self.cur.execute("CREATE TABLE Flaps(Cluster TEXT NOT NULL DEFAULT '', Name TEXT, State INT, Comment TEXT, Start INTEGER, Last INTEGER,"
+                         " End INTEGER, Count INT, Quiet INT)")
+        self.cur.execute("CREATE INDEX FlapsClusterNameEnd ON Flaps(Cluster, Name, End)")
+        self.cur.execute("CREATE INDEX FlapsStart ON Flaps(Start)")
+
+    def migrate_13(self):
+        """
+        Index history by state, state filters list the matching combinations of state bits
+        """
+        self.cur.execute("CREATE INDEX NodeStatesDataStateTime ON NodeStatesData(State, Time)")
+
+    def migrate_14(self):
+        """
+        Last known state of up nodes that are not free, for tracking every node state
+        """
+        self.cur.execute("CREATE TABLE NodeActivity(Cluster TEXT NOT NULL DEFAULT '', Name TEXT, State INT, PRIMARY KEY(Cluster, Name))")
+
+    def migrate_15(self):
+        """
+        Summary cache of the latest state of each node, since when and its failures in the month, built from the history
+        """
+        self.cur.execute("CREATE TABLE NodeSummary(Cluster TEXT NOT NULL DEFAULT '', Name TEXT, State INT, Comment TEXT, Since INTEGER, "
+                         "Month INTEGER, Failures INT, PRIMARY KEY(Cluster, Name))")
+        self.refresh_summary()
+
+    def migrate_16(self):
+        """
+        Never reuse history ids, compaction may delete the newest rows and --changes cursors and the summary cache refer to ids
+        """
+        # Copied before anything is dropped, migrate_db rolls all of it back if the migration fails
+        self.cur.execute("CREATE TABLE NodeStatesDataNew(Id INTEGER PRIMARY KEY AUTOINCREMENT, NodeId INTEGER NOT NULL, State INT,"
+                         " CommentId INTEGER NOT NULL, Time INTEGER, Cluster TEXT NOT NULL DEFAULT '')")
+        self.cur.execute("INSERT INTO NodeStatesDataNew SELECT * FROM NodeStatesData ORDER BY Id")
+        self.cur.execute("DROP VIEW NodeStates")
+        self.cur.execute("DROP TABLE NodeStatesData")
+        self.cur.execute("ALTER TABLE NodeStatesDataNew RENAME TO NodeStatesData")
+        self.cur.execute("CREATE INDEX NodeStatesDataTime ON NodeStatesData(Time)")
+        self.cur.execute("CREATE INDEX NodeStatesDataNodeTime ON NodeStatesData(NodeId, Time)")
+        self.cur.execute("CREATE INDEX NodeStatesDataClusterTime ON NodeStatesData(Cluster, Time)")
+        self.cur.execute("CREATE INDEX NodeStatesDataComment ON NodeStatesData(CommentId)")
+        self.cur.execute("CREATE INDEX NodeStatesDataStateTime ON NodeStatesData(State, Time)")
+        self.create_node_states_view()
+
+        # Ids handed out before may already have been deleted, continue after the highest id checkpoints and the summary refer to
+        self.cur.execute("SELECT MAX(Id) FROM (SELECT MAX(Id) AS Id FROM NodeStatesData UNION ALL SELECT MAX(LastId) FROM FailedNodesCheckpoints"
+                         " UNION ALL SELECT CAST(Value AS INTEGER) FROM Metadata WHERE Key='summary_last_id')")
+        last_id = self.cur.fetchone()[0] or 0
+        self.cur.execute("DELETE FROM sqlite_sequence WHERE name='NodeStatesData'")
+        self.cur.execute("INSERT INTO sqlite_sequence VALUES('NodeStatesData', ?)", (last_id,))
+
+    def migrate_17(self):
+        """
+        Store archived months in blocks of HISTORY_BATCH_SIZE rows, so a month is never decompressed or compressed whole
+        """
+        self.cur.execute("CREATE TABLE NodeStatesArchiveBlocks(Month TEXT, Block INTEGER, Rows INTEGER, Data BLOB, PRIMARY KEY(Month, Block))")
+        self.cur.execute("SELECT Month FROM NodeStatesArchive WHERE Rows>0")
+        for month in [row[0] for row in self.cur.fetchall()]:
+            self.cur.execute("SELECT Data FROM NodeStatesArchive WHERE Month=?", (month,))
+            self.write_archive_blocks(month, TrackNodes.compressed_lines(self.cur.fetchone()[0]))
+        self.cur.execute("CREATE TABLE NodeStatesArchiveMonths(Month TEXT PRIMARY KEY, Start INTEGER, End INTEGER, Rows INTEGER)")
+        self.cur.execute("INSERT INTO NodeStatesArchiveMonths SELECT Month, Start, End, Rows FROM NodeStatesArchive")
+        self.cur.execute("DROP TABLE NodeStatesArchive")
+        self.cur.execute("ALTER TABLE NodeStatesArchiveMonths RENAME TO NodeStatesArchive")
+
+    def has_table(self, table):
+        """
+        Return True if the database has the table
+        """
+        self.cur.execute("SELECT 1 FROM sqlite_master WHERE name=?", (table,))
+        return self.cur.fetchone() is not None
+
+    def get_metadata(self, key):
+        """
+        Return the value stored for key in the Metadata table or None
+        """
+        self.cur.execute("SELECT Value FROM Metadata WHERE Key=?", (key,))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def metadata_key(self, key):
+        """
+        Metadata key specific to the cluster, the default cluster uses the key as is
+        """
+        if self.cluster:
+            return "%s:%s" % (key, self.cluster)
+        return key
+
+    def set_metadata(self, key, value):
+        """
+        Store value for key in the Metadata table
+        """
+        with self.con:
+            self.cur.execute("INSERT OR REPLACE INTO Metadata VALUES(?, ?)", (key, value))
 
     def detect_resourcemanager(self):
         nodes_cmd_base = os.path.basename(self.nodes_cmd).strip()
         if nodes_cmd_base == "sinfo":
             self.resourcemanager = "slurm"
         elif nodes_cmd_base == "pbsnodes":
-            if self.detect_pbspro() == True:
-                self.resourcemanager = "pbspro"
+            nodes_cmd_id = self.nodes_cmd_id()
+            if nodes_cmd_id is not None and self.get_metadata(self.metadata_key("nodes_cmd_id")) == nodes_cmd_id:
+                self.resourcemanager = self.get_metadata(self.metadata_key("resourcemanager"))
             else:
-                self.resourcemanager = "torque"
+                if self.detect_pbspro() == True:
+                    self.resourcemanager = "pbspro"
+                else:
+                    self.resourcemanager = "torque"
+                if nodes_cmd_id is not None:
+                    # Written before the binary id, so an interrupted write is detected again next run
+                    self.set_metadata(self.metadata_key("resourcemanager"), self.resourcemanager)
+                    self.set_metadata(self.metadata_key("nodes_cmd_id"), nodes_cmd_id)
         else:
             raise Exception("Unable to determine resource manager for nodes_cmd: %s, binary: %s" % (self.nodes_cmd, nodes_cmd_base))
 
         if self.verbose:
             print("Resource Manager Detected as %s" % self.resourcemanager)
 
-    def online_nodes(self):
+    def last_failed_nodes(self):
+        """
+        Return the previously recorded failed nodes as a dict of {nodename: (state, comment)}
+        """
+        self.cur.execute("SELECT Name,State,Comment FROM CurrentFailedNodes WHERE Cluster=?", (self.cluster or '',))
+        return dict((row[0], (row[1], row[2])) for row in self.cur)
+
+    def nodes_cmd_id(self):
+        """
+        Identify the nodes command binary by its resolved path, mtime and size, so detection is redone when it changes
+        Returns None if there is no database to cache detection in or the binary cannot be found
+        """
+        if self.con is None:
+            return None
+        nodes_cmd = TrackNodes.which(self.nodes_cmd)
+        if nodes_cmd is None:
+            return None
+        nodes_cmd = os.path.realpath(nodes_cmd)
+        try:
+            nodes_cmd_stat = os.stat(nodes_cmd)
+        except OSError:
+            return None
+        return "%s:%d:%d" % (nodes_cmd, nodes_cmd_stat.st_mtime, nodes_cmd_stat.st_size)
+
+    def online_nodes(self, last_failed=None):
         """
         Update database for newly onlined nodes, remove from the online nodes and from the CurrentFailedNodes database
         """
-        onlinenodes = []
-        found = False
+        if last_failed is None:
+            last_failed = self.last_failed_nodes()
 
-        self.cur.execute("SELECT Name,State,Comment FROM CurrentFailedNodes")
-        last_failed = self.cur.fetchall()
+        current_names = set(node[0] for node in self.current_failed)
+        onlinenodes = [nodename for nodename in last_failed if nodename not in current_names]
 
-        for lx in last_failed:
-            found = False
-            for cx in self.current_failed:
-                if (lx[0] == cx[0]):
-                    found = True
-                    break
-            if (False == found):
-                onlinenodes.append(lx)
+        self.add_count("nodes_onlined", len(onlinenodes))
+        self.add_count("rows_written", len(onlinenodes))
 
-        for node in onlinenodes:
-            self.cur.execute("INSERT INTO NodeStates VALUES(?, ?, ?, datetime('now'))", (node[0], 0, ''))
-            self.cur.execute("DELETE FROM CurrentFailedNodes WHERE Name LIKE ?", (node[0],))
-            self.con.commit()
+        cluster = self.cluster or ''
+        now = int(time.time())
+        times = self.change_times
+        # With full the node is recorded in the state it came back in, such as job-exclusive
+        activity = self.current_activity or {}
+        self.onlined_nodes = [(nodename, activity.get(nodename, 0)) for nodename in onlinenodes]
+        self.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time, Cluster) VALUES(?, ?, '', ?, ?)",
+                             [(nodename, state, times.get(nodename, now), cluster) for (nodename, state) in self.onlined_nodes])
+        self.cur.executemany("DELETE FROM CurrentFailedNodes WHERE Cluster=? AND Name=?", [(cluster, nodename) for nodename in onlinenodes])
+        self.cur.executemany("UPDATE Downtimes SET End=? WHERE Cluster=? AND Name=? AND End IS NULL",
+                             [(times.get(nodename, now), cluster, nodename) for nodename in onlinenodes])
 
-    def fail_nodes(self):
+    def fail_nodes(self, last_failed=None):
         """
         Mark nodes as failed
         """
-        for (nodename, state, comment) in self.current_failed:
-            self.cur.execute("SELECT Name,State,Comment FROM CurrentFailedNodes WHERE Name LIKE ?", (nodename,))
-            node_record = self.cur.fetchone()
-            if (None == node_record):
-                self.cur.execute("INSERT INTO CurrentFailedNodes VALUES(?, ?, ?)", (nodename, state, comment))
-                self.cur.execute("INSERT INTO NodeStates VALUES(?, ?, ?, datetime('now'))", (nodename, state, comment))
-                self.con.commit()
+        if last_failed is None:
+            last_failed = self.last_failed_nodes()
+
+        # Later duplicates of a node win, matching the order rows would have been applied in
+        failed = dict((nodename, (state, comment)) for (nodename, state, comment) in self.current_failed)
+
+        newnodes = [(nodename, state, comment) for (nodename, (state, comment)) in failed.items()
+                    if nodename not in last_failed]
+        # Also record historical state and comment changes
+        changednodes = [(nodename, state, comment) for (nodename, (state, comment)) in failed.items()
+                        if nodename in last_failed and not last_failed[nodename][1] == comment]
+
+        self.add_count("nodes_failed", len(failed))
+        self.add_count("nodes_newly_failed", len(newnodes))
+        self.add_count("nodes_changed", len(changednodes))
+        self.add_count("rows_written", len(newnodes) + len(changednodes))
+
+        cluster = self.cluster or ''
+        self.cur.executemany("INSERT INTO CurrentFailedNodes(Name, State, Comment, Cluster) VALUES(?, ?, ?, ?)",
+                             [(nodename, state, comment, cluster) for (nodename, state, comment) in newnodes])
+        self.cur.executemany("UPDATE CurrentFailedNodes SET State=?,Comment=? WHERE Cluster=? AND Name=?",
+                             [(state, comment, cluster, nodename) for (nodename, state, comment) in changednodes])
+        now = int(time.time())
+        times = self.change_times
+        self.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time, Cluster) VALUES(?, ?, ?, ?, ?)",
+                             [(nodename, state, comment, times.get(nodename, now), cluster)
+                              for (nodename, state, comment) in newnodes + changednodes])
+        # Downtimes keep the latest state and comment of the outage
+        self.cur.executemany("INSERT INTO Downtimes VALUES(?, ?, ?, ?, ?, NULL)",
+                             [(cluster, nodename, state, comment, times.get(nodename, now)) for (nodename, state, comment) in newnodes])
+        self.cur.executemany("UPDATE Downtimes SET State=?,Comment=? WHERE Cluster=? AND Name=? AND End IS NULL",
+                             [(state, comment, cluster, nodename) for (nodename, state, comment) in changednodes])
+
+    def update_nodes(self):
+        """
+        Apply the difference between the last and current failed nodes in a single transaction
+        """
+        self.change_times = {}
+        try:
+            last_failed = self.last_failed_nodes()
+            with self.timed_phase("debounce_nodes"):
+                self.debounce_nodes(last_failed)
+            with self.timed_phase("online_nodes"):
+                self.online_nodes(last_failed)
+            with self.timed_phase("fail_nodes"):
+                self.fail_nodes(last_failed)
+            with self.timed_phase("activity_nodes"):
+                self.activity_nodes()
+        except:
+            self.con.rollback()
+            # The last known states may be ahead of the database
+            self.activity = None
+            raise
+        with self.timed_phase("commit"):
+            self.con.commit()
+
+    def activity_nodes(self):
+        """
+        With full, record changes of the state of up nodes, such as free to job-exclusive, against their last known state
+        The last known states are read from NodeActivity once and then kept in memory, so an update only writes the changes
+        """
+        if self.current_activity is None:
+            return
+        cluster = self.cluster or ''
+        if self.activity is None:
+            self.cur.execute("SELECT Name, State FROM NodeActivity WHERE Cluster=?", (cluster,))
+            self.activity = dict(self.cur.fetchall())
+
+        # Recorded failed nodes, including nodes the debounce keeps failed, are not up
+        failed = set(nodename for (nodename, state, comment) in self.current_failed)
+        onlined = dict(self.onlined_nodes)
+        changed = [(nodename, state) for (nodename, state) in self.current_activity.items()
+                   if nodename not in failed and self.activity.get(nodename, 0) != state]
+        gone = [nodename for nodename in self.activity if nodename in failed]
+
+        # online_nodes already recorded the state of nodes that came back
+        recorded = [(nodename, state) for (nodename, state) in changed if nodename not in onlined]
+        self.add_count("nodes_active", len(self.current_activity))
+        self.add_count("activity_changed", len(recorded))
+        self.add_count("rows_written", len(recorded))
+        now = int(time.time())
+        self.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time, Cluster) VALUES(?, ?, '', ?, ?)",
+                             [(nodename, state, now, cluster) for (nodename, state) in recorded])
+        self.cur.executemany("INSERT OR REPLACE INTO NodeActivity VALUES(?, ?, ?)",
+                             [(cluster, nodename, state) for (nodename, state) in changed if state])
+        self.cur.executemany("DELETE FROM NodeActivity WHERE Cluster=? AND Name=?",
+                             [(cluster, nodename) for (nodename, state) in changed if not state] + [(cluster, nodename) for nodename in gone])
+
+        for (nodename, state) in changed:
+            if state:
+                self.activity[nodename] = state
+            else:
+                self.activity.pop(nodename, None)
+        for nodename in gone:
+            del self.activity[nodename]
+
+    def debounce_nodes(self, last_failed):
+        """
+        Hold back changes of nodes until they persisted for more than debounce updates, so flapping nodes do not write a row per update
+        Changes that revert or are replaced by another change within the window are counted in the Flaps table instead
+        Replaces current_failed with the states to record, and sets change_times to the time recorded changes were first seen
+        """
+        cluster = self.cluster or ''
+        if not self.debounce:
+            self.cur.execute("DELETE FROM PendingChanges WHERE Cluster=?", (cluster,))
+            return
+
+        now = int(time.time())
+        observed = dict((nodename, (state, comment)) for (nodename, state, comment) in self.current_failed)
+        self.cur.execute("SELECT Name, State, Comment, Since, Cycles FROM PendingChanges WHERE Cluster=?", (cluster,))
+        pending = dict((row[0], row[1:]) for row in self.cur.fetchall())
+
+        # Changes as fail_nodes and online_nodes see them, failing, onlining or a new comment
+        changed = set(nodename for nodename in set(observed) | set(last_failed)
+                      if (nodename in observed) != (nodename in last_failed)
+                      or (nodename in observed and observed[nodename][1] != last_failed[nodename][1]))
+
+        held = {}
+        flaps = {}
+        for nodename in changed | set(pending):
+            if nodename in pending:
+                (pending_state, pending_comment, since, cycles) = pending[nodename]
+                if observed.get(nodename, (0, '')) != (pending_state, pending_comment):
+                    flaps[nodename] = (pending_state, pending_comment, since)
+            if nodename not in changed:
+                continue
+            (state, comment) = observed.get(nodename, (0, ''))
+            if nodename in pending:
+                # The node has not been in its recorded state since the first change
+                cycles += 1
+            else:
+                (since, cycles) = (now, 1)
+            if cycles > self.debounce:
+                self.change_times[nodename] = since
             else:
-                # Also record historical state and comment changes
-                if node_record[0] == nodename and not node_record[2] == comment:
-                    self.cur.execute("UPDATE CurrentFailedNodes SET State=?,Comment=? WHERE Name=?", (state, comment, nodename))
-                    self.cur.execute("INSERT INTO NodeStates VALUES(?, ?, ?, datetime('now'))", (nodename, state, comment))
-                    self.con.commit()
+                held[nodename] = (state, comment, since, cycles)
+
+        # Held back nodes keep their recorded state
+        for nodename in held:
+            if nodename in last_failed:
+                observed[nodename] = last_failed[nodename]
+            else:
+                observed.pop(nodename, None)
+        self.current_failed = [(nodename, state, comment) for (nodename, (state, comment)) in observed.items()]
+
+        self.add_count("changes_held", len(held))
+        self.add_count("flaps", len(flaps))
+        self.cur.execute("DELETE FROM PendingChanges WHERE Cluster=?", (cluster,))
+        self.cur.executemany("INSERT INTO PendingChanges VALUES(?, ?, ?, ?, ?, ?)",
+                             [(cluster, nodename, state, comment, since, cycles) for (nodename, (state, comment, since, cycles)) in held.items()])
+
+        self.cur.execute("SELECT Name FROM Flaps WHERE Cluster=? AND End IS NULL", (cluster,))
+        flapping = set(row[0] for row in self.cur.fetchall())
+        self.cur.execute("UPDATE Flaps SET Quiet=Quiet+1 WHERE Cluster=? AND End IS NULL", (cluster,))
+        self.cur.executemany("UPDATE Flaps SET Count=Count+1,State=?,Comment=?,Last=?,Quiet=0 WHERE Cluster=? AND Name=? AND End IS NULL",
+                             [(state, comment, now, cluster, nodename) for (nodename, (state, comment, since)) in flaps.items()
+                              if nodename in flapping])
+        self.cur.executemany("INSERT INTO Flaps VALUES(?, ?, ?, ?, ?, ?, NULL, 1, 0)",
+                             [(cluster, nodename, state, comment, since, now) for (nodename, (state, comment, since)) in flaps.items()
+                              if nodename not in flapping])
+        self.cur.executemany("UPDATE Flaps SET Quiet=0 WHERE Cluster=? AND Name=? AND End IS NULL",
+                             [(cluster, nodename) for nodename in held if nodename in flapping])
+        self.cur.execute("UPDATE Flaps SET End=Last WHERE Cluster=? AND End IS NULL AND Quiet>?", (cluster, self.debounce))
+
+    @contextlib.contextmanager
+    def timed_phase(self, phase):
+        """
+        Add the seconds spent in the block to the phase
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phase_seconds[phase] = self.phase_seconds.get(phase, 0) + time.time() - start
+
+    def add_count(self, name, value=1):
+        """
+        Add to a count of the update cycle
+        """
+        self.counts[name] = self.counts.get(name, 0) + value
 
     def detect_pbspro(self):
         """
         Detect if its PBSpro vs Torque
         """
-        pbsnodes_stdout, pbsnodes_stderr = Popen([self.nodes_cmd, '--version'], stdout=PIPE, stderr=PIPE).communicate()
+        pbsnodes_stdout, pbsnodes_stderr = Popen([self.nodes_cmd, '--version'], stdout=PIPE, stderr=PIPE,
+                                                   universal_newlines=True).communicate()
         for pbsnodes_out in [pbsnodes_stdout, pbsnodes_stderr]:
             for line in pbsnodes_out.strip().split("\n"):
                 fields = line.split()
@@ -195,7 +1164,15 @@ class TrackNodes:
         raise Exception("Unable to determine PBSpro or Torque")
 
     def parse_nodes_cmd(self):
-        if self.resourcemanager == "torque":
+        if self.full:
+            if self.resourcemanager == "pbspro":
+                self.parse_pbsnodes_json()
+            elif self.resourcemanager == "slurm":
+                self.parse_sinfo_nodes()
+            else:
+                raise Exception("Unable to track every node state with nodes_cmd: %s, supported for pbspro and slurm, not: %s" %
+                                (self.nodes_cmd, self.resourcemanager))
+        elif self.resourcemanager == "torque":
             self.parse_pbsnodes_cmd("-nl")
         elif self.resourcemanager == "pbspro":
             self.parse_pbsnodes_cmd("-l")
@@ -204,17 +1181,93 @@ class TrackNodes:
         else:
             raise Exception("Unable to parse nodes_cmd: %s, unsupported resource manager: %s" % (self.nodes_cmd, self.resourcemanager))
 
+    def run_nodes_cmd(self, cmd_args, chunk_size=None):
+        """
+        Run the nodes command and yield its output line by line as it is produced, or in chunks of chunk_size characters
+        Raises NodesCmdTimeout if the command does not finish within the timeout and NodesCmdError if it exits with an error
+        """
+        timeout = self.timeout
+        if timeout is None:
+            timeout = NODES_CMD_TIMEOUT
+
+        # Errors are kept for the reason of a failed update, a file does not block the command like an unread pipe
+        errors = tempfile.TemporaryFile(mode="w+")
+        # Own process group, so children of wrapper scripts such as ssh are killed with the command
+        try:
+            proc = Popen([self.nodes_cmd] + cmd_args, stdout=PIPE, stderr=errors, universal_newlines=True, start_new_session=True)
+        except TypeError:
+            # start_new_session is not supported by python2
+            proc = Popen([self.nodes_cmd] + cmd_args, stdout=PIPE, stderr=errors, universal_newlines=True, preexec_fn=os.setsid)
+        timed_out = []
+        finished = []
+        eof = []
+
+        def kill():
+            """ Kill the process group of the nodes command, closing its output ends the parsing """
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                # Exited in the meantime
+                pass
+
+        def timeout_kill():
+            """ Kill the nodes command unless its output was read, the command may have exited leaving children holding it """
+            if not finished:
+                timed_out.append(True)
+                kill()
+
+        timer = None
+        if timeout > 0:
+            timer = threading.Timer(timeout, timeout_kill)
+            timer.daemon = True
+            timer.start()
+        # Time blocked on the command, the rest of parse_nodes_cmd is spent parsing
+        waited = 0
+        try:
+            while True:
+                start = time.time()
+                if chunk_size is None:
+                    line = proc.stdout.readline()
+                else:
+                    line = proc.stdout.read(chunk_size)
+                waited += time.time() - start
+                if not line:
+                    eof.append(True)
+                    break
+                if chunk_size is None:
+                    line = line.rstrip("\n")
+                yield line
+        finally:
+            finished.append(True)
+            self.phase_seconds["nodes_cmd"] = self.phase_seconds.get("nodes_cmd", 0) + waited
+            if timer is not None:
+                timer.cancel()
+            if not eof and not timed_out and proc.poll() is None:
+                # Parsing stopped early, do not leave the command running
+                kill()
+            proc.wait()
+            errors.seek(0)
+            error = errors.read().strip()
+            errors.close()
+
+        if timed_out:
+            raise NodesCmdTimeout("nodes_cmd: %s %s did not finish within %g seconds" % (self.nodes_cmd, ' '.join(cmd_args), timeout))
+        if proc.returncode:
+            raise NodesCmdError("nodes_cmd: %s %s exited with status %d: %s" % (self.nodes_cmd, ' '.join(cmd_args), proc.returncode,
+                                                                             error.split("\n")[-1]))
+
     def parse_pbsnodes_cmd(self, cmd_args):
         """
         Run pbsnodes -nl (Torque) or pbsnodes -l (PBSpro) and parse the output and return an array of tuples [(nodename, state, comment),]
         """
-        for line in Popen([self.nodes_cmd, cmd_args], stdout=PIPE, stderr=PIPE).communicate()[0].rstrip().split("\n"):
+        for line in self.run_nodes_cmd([cmd_args]):
             fields = line.split()
             if len(fields) == 2:
                 self.current_failed.append((fields[0], TrackNodes.encode_state(fields[1]), ''))
             elif len(fields) >= 3:
                 self.current_failed.append((fields[0], TrackNodes.encode_state(fields[1]), ' '.join(fields[2::])))
             else:
+                self.add_count("parse_errors")
                 if self.verbose:
                     print("Parse Error on line: '%s'" % line)
 
@@ -223,40 +1276,260 @@ class TrackNodes:
         Run sinfo -dR (slurm) and parse the output and return an array of tuples [(nodename, state, comment),]
         """
         line_num = 0
-        for line in Popen([self.nodes_cmd, '-dR'], stdout=PIPE, stderr=PIPE).communicate()[0].rstrip().split("\n"):
+        for line in self.run_nodes_cmd(['-dR']):
             # Skip First Line
             if line_num == 0:
                 line_num += 1
                 continue
 
-            m = re.search(r'^(.*?)\s+([a-zA-Z0-9\-_]+)\s+([0-9\-:T]+)\s+([a-zA-Z0-9_\-]+)$', line)
+            m = SINFO_LINE_RE.match(line)
             if m:
                 reason = m.group(1)
                 username = m.group(2)
                 timestamp = m.group(3)
-                nodename = m.group(4)
+                nodenames = [m.group(4)]
+                if "[" in nodenames[0] or "," in nodenames[0]:
+                    try:
+                        nodenames = list(TrackNodes.expand_hostlist(nodenames[0]))
+                    except ValueError:
+                        nodenames = None
+            if m and nodenames:
                 # -dR returns only down nodes, so the state is down
-                self.current_failed.append((nodename, TrackNodes.encode_state('down'), reason))
+                state = TrackNodes.encode_state('down')
+                self.current_failed.extend((nodename, state, reason) for nodename in nodenames)
             else:
+                self.add_count("parse_errors")
                 if self.verbose:
                     print("Parse Error on line: '%s'" % line)
 
             line_num += 1
 
-    @staticmethod
-    def which(program):
+    def parse_pbsnodes_json(self):
         """
-        Find Full Path
+        Run pbsnodes -av -F json (PBSpro) and parse the state of every node, nodes are decoded one at a time as the output is read
         """
-        def is_exe(fpath):
-            """ File must have execute bit set """
-            return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+        chunks = self.run_nodes_cmd(["-av", "-F", "json"], chunk_size=JSON_CHUNK_SIZE)
+        for (nodename, attributes) in TrackNodes.json_object_items(chunks, "nodes"):
+            if not isinstance(attributes, dict) or "state" not in attributes:
+                self.add_count("parse_errors")
+                if self.verbose:
+                    print("Parse Error on node: '%s'" % nodename)
+                continue
+            self.add_node_state(nodename, TrackNodes.encode_state(attributes["state"]), attributes.get("comment", ""))
 
-        if program is None:
-            return None
+    def parse_sinfo_nodes(self):
+        """
+        Run sinfo -N with a fixed format (slurm) and parse the state of every node, one line per node and partition
+        """
+        for line in self.run_nodes_cmd(["-N", "-h", "-o", "%N|%T|%E"]):
+            fields = line.split("|", 2)
+            if len(fields) == 3 and fields[0]:
+                (nodename, slurm_state, reason) = fields
+                if reason == "none":
+                    reason = ""
+                self.add_node_state(nodename, TrackNodes.encode_slurm_state(slurm_state), reason)
+            else:
+                self.add_count("parse_errors")
+                if self.verbose:
+                    print("Parse Error on line: '%s'" % line)
 
-        fpath, fname = os.path.split(program)
-        if fpath:
+    def add_node_state(self, nodename, state, comment):
+        """
+        Add a node of the full output, to the failed nodes if its state has any of FAILED_STATES and otherwise to the up nodes
+        """
+        if state & FAILED_STATES:
+            self.current_failed.append((nodename, state, comment))
+        else:
+            self.current_activity[nodename] = state
+
+    @staticmethod
+    def encode_slurm_state(slurm_state):
+        """
+        Convert a slurm node state such as allocated, idle+drain or down* to the state bits
+        Flags such as * for not responding are stripped, a node that is not responding is also state-unknown
+        """
+        state = TrackNodes.encoded_slurm_states.get(slurm_state)
+        if state is None:
+            state = 0
+            for token in slurm_state.lower().split("+"):
+                state |= SLURM_STATES.get(token.rstrip("*~#!%$@^-"), 1024)
+                if token.endswith("*"):
+                    state |= 128
+            TrackNodes.encoded_slurm_states[slurm_state] = state
+        return state
+
+    @staticmethod
+    def json_object_items(chunks, member):
+        """
+        Yield the (key, value) pairs of the object of a member of JSON text read in chunks, such as the nodes of pbsnodes -F json
+        Each pair is decoded once it has been read completely, so only one node at a time is held in memory
+        Raises ValueError if the text ends before the object
+        """
+        decoder = json.JSONDecoder()
+        chunks = iter(chunks)
+        marker = '"%s"' % member
+        buf = ""
+        while True:
+            found = buf.find(marker)
+            if found >= 0 and buf.find("{", found) >= 0:
+                pos = buf.find("{", found) + 1
+                break
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError("JSON has no object %s" % member)
+            buf += chunk
+
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buf) and buf[pos] == "}":
+                return
+            try:
+                (key, end) = decoder.raw_decode(buf, pos)
+                colon = JSON_COLON_RE.match(buf, end)
+                if colon is None:
+                    raise ValueError("Expecting ':' after %s" % key)
+                (value, end) = decoder.raw_decode(buf, colon.end())
+            except ValueError:
+                # Incomplete, drop what was decoded before reading more
+                chunk = next(chunks, None)
+                if chunk is None:
+                    raise ValueError("JSON ended inside object %s" % member)
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield (key, value)
+            pos = end
+
+    @staticmethod
+    def expand_hostlist(hostlist):
+        """
+        Expand a slurm hostlist such as r1n[001-480,512],login1 into node names, yielded one at a time
+        Raises ValueError if the hostlist is malformed
+        """
+        depth = 0
+        start = 0
+        for (i, c) in enumerate(hostlist):
+            if c == "[":
+                depth += 1
+            elif c == "]":
+                depth -= 1
+            elif c == "," and depth == 0:
+                for nodename in TrackNodes.expand_hostname(hostlist[start:i]):
+                    yield nodename
+                start = i + 1
+        if depth != 0:
+            raise ValueError("Unbalanced brackets in hostlist: %s" % hostlist)
+        for nodename in TrackNodes.expand_hostname(hostlist[start:]):
+            yield nodename
+
+    @staticmethod
+    def expand_hostname(hostname):
+        """
+        Expand the ranges of one hostlist entry, such as r[1-2]n[01-04], keeping the zero padding of the range
+        """
+        bracket = hostname.find("[")
+        if bracket < 0:
+            if hostname:
+                yield hostname
+            return
+        end = hostname.index("]", bracket)
+        prefix = hostname[:bracket]
+        suffix = hostname[end + 1:]
+        suffixes = list(TrackNodes.expand_hostname(suffix)) if "[" in suffix else [suffix]
+        for part in hostname[bracket + 1:end].split(","):
+            (first, dash, last) = part.partition("-")
+            if not first.isdigit() or (dash and not last.isdigit()):
+                raise ValueError("Invalid range in hostlist: %s" % hostname)
+            if not dash:
+                numbers = [first]
+            else:
+                numbers = ("%0*d" % (len(first), number) for number in range(int(first), int(last) + 1))
+            for number in numbers:
+                for tail in suffixes:
+                    yield prefix + number + tail
+
+    @staticmethod
+    def compress_hostlist(nodenames):
+        """
+        Compress node names into a slurm hostlist, names sharing a prefix are grouped into sorted ranges of their trailing number
+        """
+        plain = []
+        numbered = []
+        padded = set()
+        for nodename in set(nodenames):
+            prefix = nodename.rstrip("0123456789")
+            if len(prefix) == len(nodename):
+                plain.append(nodename)
+                continue
+            digits = nodename[len(prefix):]
+            if len(digits) > 1 and digits[0] == "0":
+                padded.add((prefix, len(digits)))
+            numbered.append((prefix, digits))
+
+        # Numbers as wide as zero padded numbers of the prefix share their range, n[098-100], others are not padded, n[9-10]
+        groups = {}
+        for (prefix, digits) in numbered:
+            width = len(digits) if (prefix, len(digits)) in padded else 0
+            groups.setdefault((prefix, width), []).append(int(digits))
+
+        entries = [(nodename, nodename) for nodename in plain]
+        for ((prefix, width), numbers) in groups.items():
+            numbers.sort()
+            ranges = []
+            first = last = numbers[0]
+            for number in numbers[1:] + [None]:
+                if number is not None and number == last + 1:
+                    last = number
+                    continue
+                if first == last:
+                    ranges.append("%0*d" % (width, first))
+                else:
+                    ranges.append("%0*d-%0*d" % (width, first, width, last))
+                first = last = number
+            if len(numbers) == 1:
+                entries.append((prefix + ranges[0], prefix))
+            else:
+                entries.append(("%s[%s]" % (prefix, ",".join(ranges)), prefix))
+        return ",".join(entry for (entry, key) in sorted(entries, key=lambda entry: (entry[1], entry[0])))
+
+    @staticmethod
+    def group_hostlists(rows):
+        """
+        Group rows of (nodename, state, comment, cluster) by state and comment into compressed hostlists, in order of first appearance
+        Returns a list of tuples of (hostlist, state, comment), the hostlist is prefixed with cluster: for nodes of a named cluster
+        """
+        groups = {}
+        order = []
+        for (nodename, state, comment, cluster) in rows:
+            key = (cluster, state, comment)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(nodename)
+        result = []
+        for key in order:
+            (cluster, state, comment) = key
+            hostlist = TrackNodes.compress_hostlist(groups[key])
+            if cluster:
+                hostlist = "%s:%s" % (cluster, hostlist)
+            result.append((hostlist, state, comment))
+        return result
+
+    @staticmethod
+    def which(program):
+        """
+        Find Full Path
+        """
+        def is_exe(fpath):
+            """ File must have execute bit set """
+            return os.path.isfile(fpath) and os.access(fpath, os.X_OK)
+
+        if program is None:
+            return None
+
+        fpath, fname = os.path.split(program)
+        if fpath:
             if is_exe(program):
                 return program.strip()
         else:
@@ -273,29 +1546,19 @@ class TrackNodes:
         """
         Convert from pbsnodes text documentation to binary 0 = online, 1 = offline, 2 = down, 3 = offline|down
         Valid state strings are "free","offline","down","reserve","job-exclusive","job-sharing","busy","time-shared", or "state-unknown".
+        The few distinct state strings are encoded once and then looked up
         """
-        state = 0
-        if ("free" in str):
-            return 0
-        if ("offline" in str):
-            state = state | 1
-        if ("down" in str):
-            state = state | 2
-        if ("reserve" in str):
-            state = state | 4
-        if ("job-exclusive" in str):
-            state = state | 8
-        if ("job-sharing" in str):
-            state = state | 16
-        if ("busy" in str):
-            state = state | 32
-        if ("time-shared" in str):
-            state = state | 64
-        if ("state-unknown" in str):
-            state = state | 128
-        if (state == 0):
-            """ Undetected State """
-            state = state | 1024
+        state = TrackNodes.encoded_states.get(str)
+        if state is None:
+            tokens = STATE_SPLIT_RE.split(str.strip())
+            state = 0
+            if "free" not in tokens:
+                for token in tokens:
+                    state |= STATE_TOKENS.get(token, 0)
+                if (state == 0):
+                    """ Undetected State """
+                    state = 1024
+            TrackNodes.encoded_states[str] = state
         return state
 
     @staticmethod
@@ -303,30 +1566,987 @@ class TrackNodes:
         """
         Convert from binary notation to the pbsnodes text documentation
         """
-        str = ""
         if (state is None):
             return "undetected-state"
-        if (state == 0):
-            return "online"
-        if (state & 1 == 1):
-            str += "offline,"
-        if (state & 2 == 2):
-            str += "down,"
-        if (state & 4 == 4):
-            str += "reserve,"
-        if (state & 8 == 8):
-            str += "job-exclusive,"
-        if (state & 16 == 16):
-            str += "job-sharing,"
-        if (state & 32 == 32):
-            str += "busy,"
-        if (state & 64 == 64):
-            str += "time-shared,"
-        if (state & 128 == 128):
-            str += "state-unknown,"
-        if (state & 1024 == 1024):
-            str += "undetected-state,"
-        return str.rstrip(",")
+        name = STATE_NAMES.get(state)
+        if name is None:
+            # Unknown bits are ignored
+            name = ",".join(name for (name, bit) in STATE_BITS if state & bit)
+        return name
+
+    @staticmethod
+    def parse_time(value):
+        """
+        Convert a time given as seconds since the epoch or as ISO8601 UTC text to seconds since the epoch
+        """
+        if value is None or isinstance(value, int):
+            return value
+        value = str(value).strip()
+        if value.isdigit():
+            return int(value)
+        for time_format in ["%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+            try:
+                return calendar.timegm(time.strptime(value, time_format))
+            except ValueError:
+                pass
+        raise Exception("Unable to parse time: %s" % value)
+
+    @staticmethod
+    def node_clause(node):
+        """
+        SQL condition matching node names against a name or a glob
+        """
+        if any(c in node for c in "*?["):
+            return "Name GLOB ?"
+        return "Name=?"
+
+    @staticmethod
+    def node_id_clause(node):
+        """
+        SQL condition matching the interned node ids of the history against a name or a glob
+        """
+        return "NodeId IN (SELECT Id FROM Nodes WHERE %s)" % TrackNodes.node_clause(node)
+
+    def history(self, node=None, since=None, until=None, state=None, limit=None, cluster=None, archive=False):
+        """
+        Query history newest first, filters are applied in sqlite and rows are streamed in batches
+        With archive the archived history follows once NodeStates is exhausted
+        Yields tuples of (nodename, time, state, comment, cluster), time is formatted as ISO8601 UTC text
+        """
+        where = []
+        params = []
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_id_clause(node))
+            params.append(node)
+        if since is not None:
+            where.append("Time>=?")
+            params.append(TrackNodes.parse_time(since))
+        if until is not None:
+            where.append("Time<?")
+            params.append(TrackNodes.parse_time(until))
+        if state is not None:
+            where.append(self.history_state_clause(state, limit))
+
+        query = "SELECT Name, datetime(Time, 'unixepoch'), State, Comment, Cluster FROM NodeStates"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY Time DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(int(limit))
+
+        rows = self.stream_query(query, params)
+        if archive:
+            return self.chain_archived_history(rows, node=node, since=since, until=until, state=state, limit=limit, cluster=cluster)
+        return rows
+
+    def history_state_clause(self, state, limit=None):
+        """
+        SQL condition for a state filter on the history, using the state index unless the state is too common for it to pay off
+        With a limit, scanning the history in order finds the matches of a common state sooner than sorting all of them
+        The matches are counted in the index up to the point where scanning becomes cheaper, sqrt(limit * rows)
+        """
+        clause = TrackNodes.state_clause(state)
+        if limit is None:
+            return clause
+        self.cur.execute("SELECT MAX(Id) FROM NodeStatesData")
+        rows = self.cur.fetchone()[0] or 0
+        enough = int((int(limit) * rows) ** 0.5) + 1
+        self.cur.execute("SELECT COUNT(*) FROM (SELECT 1 FROM NodeStatesData WHERE %s LIMIT ?)" % clause, (enough,))
+        if self.cur.fetchone()[0] >= enough:
+            # A unary + keeps sqlite from using the index for the condition
+            return "+" + clause
+        return clause
+
+    def chain_archived_history(self, rows, node=None, since=None, until=None, state=None, limit=None, cluster=None):
+        """
+        Yield the history rows followed by the archived history, which is older than anything still in NodeStates
+        """
+        count = 0
+        for row in rows:
+            count += 1
+            yield row
+        if limit is not None:
+            limit = int(limit) - count
+            if limit <= 0:
+                return
+        for row in self.archived_history(node=node, since=since, until=until, state=state, limit=limit, cluster=cluster):
+            yield row
+
+    def archived_history(self, node=None, since=None, until=None, state=None, limit=None, cluster=None):
+        """
+        Query archived history newest first, only the months overlapping the time range are decompressed, one at a time
+        Yields tuples of (nodename, time, state, comment, cluster) like history()
+        """
+        since = TrackNodes.parse_time(since)
+        until = TrackNodes.parse_time(until)
+        if state is not None:
+            state = TrackNodes.state_filter(state)
+        query = "SELECT Month FROM NodeStatesArchive WHERE 1"
+        params = []
+        if since is not None:
+            query += " AND End>?"
+            params.append(since)
+        if until is not None:
+            query += " AND Start<?"
+            params.append(until)
+        query += " ORDER BY Start DESC"
+
+        self.cur.execute(query, params)
+        months = [row[0] for row in self.cur.fetchall()]
+
+        count = 0
+        for month in months:
+            for (nodeid, nodename, nodestate, comment, nodetime, nodecluster) in self.archive_rows(month, reverse=True):
+                if cluster is not None and nodecluster != cluster:
+                    continue
+                if node is not None and not fnmatch.fnmatchcase(nodename, node):
+                    continue
+                if since is not None and nodetime < since:
+                    continue
+                if until is not None and nodetime >= until:
+                    continue
+                if state is not None and nodestate not in state:
+                    continue
+                if limit is not None and count >= limit:
+                    return
+                count += 1
+                yield (nodename, TrackNodes.format_time(nodetime), nodestate, comment, nodecluster)
+
+    @staticmethod
+    def state_filter(state):
+        """
+        Convert a state filter to the set of encoded states it matches
+        Text such as "down,state-unknown" matches states with any of the states, "online" matches online, an encoded state matches itself
+        """
+        if isinstance(state, int):
+            return set([state])
+        mask = 0
+        values = set()
+        for token in STATE_SPLIT_RE.split(state.strip()):
+            if token == "online":
+                values.add(0)
+            elif token in STATE_TOKENS:
+                mask |= STATE_TOKENS[token]
+            else:
+                raise Exception("Unknown state: %s" % token)
+        values.update(value for value in STATE_NAMES if value & mask)
+        return values
+
+    @staticmethod
+    def state_clause(state):
+        """
+        SQL condition matching the state column against a state filter
+        The matching combinations of state bits are listed, so sqlite can look them up in an index on the state
+        """
+        return "State IN (%s)" % ",".join(str(value) for value in sorted(TrackNodes.state_filter(state)))
+
+    @staticmethod
+    def month_start(seconds, months_back=0):
+        """
+        Seconds since the epoch of the start of the UTC month containing seconds, moved back months_back months
+        """
+        tm = time.gmtime(seconds)
+        month = tm.tm_year * 12 + tm.tm_mon - 1 - months_back
+        return calendar.timegm((month // 12, month % 12 + 1, 1, 0, 0, 0, 0, 0, 0))
+
+    def compact_history(self):
+        """
+        Move history older than the retention into compressed monthly archives, then release free pages incrementally
+        Returns the number of history rows archived
+        """
+        if self.retention is None:
+            return 0
+        cutoff = TrackNodes.month_start(time.time(), self.retention)
+
+        archived = 0
+        while True:
+            # Cheap check on the Time index, so this can run on every update
+            self.cur.execute("SELECT MIN(Time) FROM NodeStatesData")
+            oldest = self.cur.fetchone()[0]
+            if oldest is None or oldest >= cutoff:
+                break
+            start = TrackNodes.month_start(oldest)
+            end = TrackNodes.month_start(start + 32 * 86400)
+            # One transaction per month keeps the write lock short
+            with self.con:
+                archived += self.archive_month(start, end)
+
+        if archived:
+            # Names and comments only the archived history referred to
+            with self.con:
+                self.cur.execute("DELETE FROM Comments WHERE NOT EXISTS (SELECT 1 FROM NodeStatesData WHERE CommentId=Comments.Id)")
+                self.cur.execute("DELETE FROM Nodes WHERE NOT EXISTS (SELECT 1 FROM NodeStatesData WHERE NodeId=Nodes.Id)")
+            self.cur.execute("PRAGMA auto_vacuum")
+            if self.cur.fetchone()[0] == 2:
+                self.cur.execute("PRAGMA incremental_vacuum(%d)" % COMPACT_VACUUM_PAGES)
+                self.cur.fetchall()
+            if self.verbose:
+                print("Archived %d history entries older than %s" % (archived, TrackNodes.format_time(cutoff)))
+        return archived
+
+    def archive_month(self, start, end):
+        """
+        Move the history between start and end into the archive of the month, merging with rows archived before
+        """
+        month = time.strftime("%Y-%m", time.gmtime(start))
+        rows = self.stream_query("SELECT Id, Name, State, Comment, Time, Cluster FROM NodeStates WHERE Time>=? AND Time<? ORDER BY Time, Id",
+                                 (start, end))
+        # Entries are only archived after their month, so they follow the entries archived before
+        archived = self.write_archive_blocks(month, (json.dumps(list(row)) for row in rows))
+        self.cur.execute("INSERT OR IGNORE INTO NodeStatesArchive VALUES(?, ?, ?, 0)", (month, start, end))
+        self.cur.execute("UPDATE NodeStatesArchive SET Rows=Rows+? WHERE Month=?", (archived, month))
+
+        # One checkpoint at the end of each archived month is kept, so --at replays at most a month of archived history
+        self.cur.execute("SELECT MAX(Id) FROM NodeStatesData WHERE Time<?", (end,))
+        last_id = self.cur.fetchone()[0] or 0
+        self.write_checkpoint(end - 1, last_id, self.failed_nodes_at(end - 1))
+        self.cur.execute("DELETE FROM FailedNodesCheckpoints WHERE Time>=? AND Time<?", (start, end - 1))
+
+        self.cur.execute("DELETE FROM NodeStatesData WHERE Time>=? AND Time<?", (start, end))
+        return self.cur.rowcount
+
+    def write_archive_blocks(self, month, lines):
+        """
+        Append JSON lines of history to the archive of a month, compressed in blocks of HISTORY_BATCH_SIZE rows
+        Returns the number of rows archived
+        """
+        self.cur.execute("SELECT MAX(Block) FROM NodeStatesArchiveBlocks WHERE Month=?", (month,))
+        block = self.cur.fetchone()[0]
+        block = 0 if block is None else block + 1
+        archived = 0
+        while True:
+            batch = list(itertools.islice(lines, HISTORY_BATCH_SIZE))
+            if not batch:
+                return archived
+            data = lite.Binary(zlib.compress("\n".join(batch).encode("utf-8")))
+            self.cur.execute("INSERT INTO NodeStatesArchiveBlocks VALUES(?, ?, ?, ?)", (month, block, len(batch), data))
+            archived += len(batch)
+            block += 1
+
+    def archive_rows(self, month, reverse=False):
+        """
+        Yield the archived rows of a month as lists of [id, nodename, state, comment, time, cluster], in the order archived or reversed
+        Only one block of rows is decompressed at a time
+        """
+        self.cur.execute("SELECT Block FROM NodeStatesArchiveBlocks WHERE Month=? ORDER BY Block%s" % (" DESC" if reverse else ""), (month,))
+        for block in [row[0] for row in self.cur.fetchall()]:
+            self.cur.execute("SELECT Data FROM NodeStatesArchiveBlocks WHERE Month=? AND Block=?", (month, block))
+            rows = [json.loads(line) for line in zlib.decompress(self.cur.fetchone()[0]).decode("utf-8").split("\n")]
+            if reverse:
+                rows.reverse()
+            for row in rows:
+                yield row
+
+    @staticmethod
+    def compressed_lines(data):
+        """
+        Yield the lines of zlib compressed text, decompressed incrementally in chunks of JSON_CHUNK_SIZE
+        """
+        decompressor = zlib.decompressobj()
+        rest = b""
+        for start in range(0, len(data), JSON_CHUNK_SIZE):
+            lines = (rest + decompressor.decompress(bytes(data[start:start + JSON_CHUNK_SIZE]))).split(b"\n")
+            rest = lines.pop()
+            for line in lines:
+                yield line.decode("utf-8")
+        rest += decompressor.flush()
+        for line in rest.split(b"\n"):
+            yield line.decode("utf-8")
+
+    def checkpoint_failed_nodes(self):
+        """
+        Snapshot CurrentFailedNodes of all clusters if the last snapshot is older than CHECKPOINT_INTERVAL
+        Returns True if a snapshot was written
+        """
+        now = int(time.time())
+        self.cur.execute("SELECT MAX(Time) FROM FailedNodesCheckpoints")
+        last = self.cur.fetchone()[0]
+        if last is not None and last > now - CHECKPOINT_INTERVAL:
+            return False
+
+        with self.con:
+            self.cur.execute("SELECT MAX(Id) FROM NodeStatesData")
+            last_id = self.cur.fetchone()[0] or 0
+            self.cur.execute("SELECT Name, State, Comment, Cluster FROM CurrentFailedNodes")
+            self.write_checkpoint(now, last_id, self.cur.fetchall())
+        return True
+
+    def write_checkpoint(self, checkpoint_time, last_id, failed):
+        """
+        Store the failed nodes, tuples of (nodename, state, comment, cluster), as of the changes up to last_id
+        """
+        rows = [json.dumps(list(row)) for row in failed]
+        data = lite.Binary(zlib.compress("\n".join(rows).encode("utf-8")))
+        self.cur.execute("INSERT OR REPLACE INTO FailedNodesCheckpoints VALUES(?, ?, ?, ?)", (checkpoint_time, last_id, len(rows), data))
+
+    def failed_nodes_at(self, at, node=None, state=None, cluster=None):
+        """
+        Rebuild the failed nodes at a time from the newest checkpoint before it and the history recorded since
+        History compaction moved into the archive is replayed from the archived months after the checkpoint
+        Returns a list of tuples of (nodename, state, comment, cluster) ordered by cluster and name
+        """
+        at = TrackNodes.parse_time(at)
+        failed = {}
+        last_id = 0
+        checkpoint_time = None
+        self.cur.execute("SELECT Time, LastId, Rows, Data FROM FailedNodesCheckpoints WHERE Time<=? ORDER BY Time DESC LIMIT 1", (at,))
+        checkpoint = self.cur.fetchone()
+        if checkpoint is not None:
+            (checkpoint_time, last_id) = checkpoint[0:2]
+            if checkpoint[2]:
+                for line in zlib.decompress(checkpoint[3]).decode("utf-8").split("\n"):
+                    (nodename, nodestate, comment, nodecluster) = json.loads(line)
+                    failed[(nodecluster, nodename)] = (nodestate, comment)
+
+        query = "SELECT Month FROM NodeStatesArchive WHERE Start<=?"
+        params = [at]
+        if checkpoint_time is not None:
+            query += " AND End>?"
+            params.append(checkpoint_time)
+        self.cur.execute(query + " ORDER BY Start", params)
+        for month in [row[0] for row in self.cur.fetchall()]:
+            # Archived rows are replayed in the order they were archived, by time
+            for (nodeid, nodename, nodestate, comment, nodetime, nodecluster) in self.archive_rows(month):
+                if nodeid <= last_id or nodetime > at:
+                    continue
+                if not nodestate & FAILED_STATES:
+                    failed.pop((nodecluster, nodename), None)
+                else:
+                    failed[(nodecluster, nodename)] = (nodestate, comment)
+
+        where = ["Id>?", "Time<=?"]
+        params = [last_id, at]
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_id_clause(node))
+            params.append(node)
+        query = "SELECT Name, State, Comment, Cluster FROM NodeStates WHERE %s ORDER BY Id" % " AND ".join(where)
+        for (nodename, nodestate, comment, nodecluster) in self.stream_query(query, params):
+            if not nodestate & FAILED_STATES:
+                failed.pop((nodecluster, nodename), None)
+            else:
+                failed[(nodecluster, nodename)] = (nodestate, comment)
+
+        if state is not None:
+            state = TrackNodes.state_filter(state)
+        result = []
+        for ((nodecluster, nodename), (nodestate, comment)) in sorted(failed.items()):
+            if cluster is not None and nodecluster != cluster:
+                continue
+            if node is not None and not fnmatch.fnmatchcase(nodename, node):
+                continue
+            if state is not None and nodestate not in state:
+                continue
+            result.append((nodename, nodestate, comment, nodecluster))
+        return result
+
+    def print_failed_at(self):
+        """
+        Print the nodes that were failed at a time to STDOUT
+        """
+        try:
+            print("Failed Nodes at %s" % TrackNodes.format_time(TrackNodes.parse_time(self.at)))
+            print("=========")
+            failed = self.failed_nodes_at(self.at, node=self.node, state=self.state, cluster=self.cluster)
+            for (hostlist, state, comment) in TrackNodes.group_hostlists(failed):
+                print("%s | %s | '%s'" % (hostlist, TrackNodes.decode_state(state), comment))
+            print("")
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to less and was quit prior to EOF
+                return
+
+    def node_changes(self, cursor=None, since=None, node=None, state=None, limit=None, cluster=None):
+        """
+        Query changes recorded after the cursor, oldest first, so consumers can poll for what is new
+        The cursor is the id of the last change seen, the range scan on the NodeStates primary key only reads new rows
+        Yields tuples of (id, nodename, time, state, comment, cluster), time is seconds since the epoch and the id is the next cursor
+        """
+        where = []
+        params = []
+        if cursor is not None:
+            where.append("Id>?")
+            params.append(int(cursor))
+        if since is not None:
+            where.append("Time>=?")
+            params.append(TrackNodes.parse_time(since))
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_id_clause(node))
+            params.append(node)
+        if state is not None:
+            where.append(self.history_state_clause(state, limit))
+
+        query = "SELECT Id, Name, Time, State, Comment, Cluster FROM NodeStates"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY Id"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        return self.stream_query(query, params)
+
+    def latest_cursor(self):
+        """
+        Return the cursor of the newest change, 0 when there are none
+        Ids are never reused, so the cursor does not go back when compaction archived the newest changes
+        """
+        self.cur.execute("SELECT seq FROM sqlite_sequence WHERE name='NodeStatesData'")
+        row = self.cur.fetchone()
+        return row[0] if row is not None else 0
+
+    def stream_query(self, query, params=()):
+        """
+        Yield the rows of a query fetched from sqlite in batches of HISTORY_BATCH_SIZE
+        """
+        # Use a separate cursor so the caller may use self.cur while iterating
+        cur = self.con.cursor()
+        cur.execute(query, params)
+        while True:
+            rows = cur.fetchmany(HISTORY_BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+        cur.close()
+
+    def downtimes(self, node=None, since=None, until=None, state=None, cluster=None):
+        """
+        Query downtime intervals overlapping the time range, newest first, using the Downtimes indexes
+        Yields tuples of (nodename, start, end, state, comment, cluster), times are seconds since the epoch, end is None while the node is failed
+        """
+        where = []
+        params = []
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_clause(node))
+            params.append(node)
+        if until is not None:
+            where.append("Start<?")
+            params.append(TrackNodes.parse_time(until))
+        if since is not None:
+            where.append("(End IS NULL OR End>?)")
+            params.append(TrackNodes.parse_time(since))
+        if state is not None:
+            where.append(TrackNodes.state_clause(state))
+
+        query = "SELECT Name, Start, End, State, Comment, Cluster FROM Downtimes"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY Start DESC"
+        return self.stream_query(query, params)
+
+    def flap_records(self, node=None, since=None, until=None, cluster=None):
+        """
+        Query flaps overlapping the time range, newest first
+        Yields tuples of (nodename, start, last, end, count, state, comment, cluster), end is None while the node is still flapping
+        State and comment are of the latest change that reverted
+        """
+        where = []
+        params = []
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_clause(node))
+            params.append(node)
+        if until is not None:
+            where.append("Start<?")
+            params.append(TrackNodes.parse_time(until))
+        if since is not None:
+            where.append("(End IS NULL OR End>=?)")
+            params.append(TrackNodes.parse_time(since))
+
+        query = "SELECT Name, Start, Last, End, Count, State, Comment, Cluster FROM Flaps"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY Start DESC"
+        return self.stream_query(query, params)
+
+    def print_flaps(self):
+        """
+        Print flaps to STDOUT
+        """
+        try:
+            print("Flaps of Nodes")
+            print("=========")
+            for (nodename, start, last, end, count, state, comment, cluster) in self.flap_records(node=self.node, since=self.since,
+                                                                                                  until=self.until, cluster=self.cluster):
+                if cluster:
+                    nodename = "%s:%s" % (cluster, nodename)
+                end_text = "ongoing" if end is None else TrackNodes.format_time(end)
+                print("%s | %s | %s | %d flaps | %s | '%s'" % (nodename, TrackNodes.format_time(start), end_text, count,
+                                                               TrackNodes.decode_state(state), comment))
+            print("")
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to less and was quit prior to EOF
+                return
+
+    def fold_summary(self):
+        """
+        Fold the history written after the summary cache into the summaries of the nodes it changed
+        Returns (last_id, {(cluster, nodename): (state, comment, since, month, failures)}), last_id is None if the cache is current
+        """
+        cached = int(self.get_metadata("summary_last_id") or 0)
+        # Cheap check on the rowid, the cache is current unless an update wrote history
+        self.cur.execute("SELECT MAX(Id) FROM NodeStatesData")
+        if (self.cur.fetchone()[0] or 0) <= cached:
+            return (None, {})
+
+        last_id = cached
+        changed = {}
+        for (nodeid, cluster, nodename, nodestate, comment, nodetime) in self.stream_query(
+                "SELECT Id, Cluster, Name, State, Comment, Time FROM NodeStates WHERE Id>? ORDER BY Id", (cached,)):
+            key = (cluster, nodename)
+            summary = changed.get(key)
+            if summary is None:
+                self.cur.execute("SELECT State, Comment, Since, Month, Failures FROM NodeSummary WHERE Cluster=? AND Name=?", key)
+                summary = self.cur.fetchone() or (0, '', None, None, 0)
+            (state, since, month, failures) = (summary[0], summary[2], summary[3], summary[4])
+
+            if nodestate & FAILED_STATES:
+                if not state & FAILED_STATES:
+                    # A new failure, counted in the month it started
+                    since = nodetime
+                    start = TrackNodes.month_start(nodetime)
+                    failures = failures + 1 if month == start else 1
+                    month = start
+            elif state & FAILED_STATES or since is None:
+                since = nodetime
+            changed[key] = (nodestate, comment or '', since, month, failures)
+            last_id = nodeid
+        return (last_id, changed)
+
+    def refresh_summary(self):
+        """
+        Update the summary cache from the history written since it was last refreshed, called by the update in its transaction
+        Returns the number of node summaries updated
+        """
+        (last_id, changed) = self.fold_summary()
+        if last_id is None:
+            return 0
+        self.cur.executemany("INSERT OR REPLACE INTO NodeSummary VALUES(?, ?, ?, ?, ?, ?, ?)",
+                             [key + summary for (key, summary) in changed.items()])
+        self.cur.execute("INSERT OR REPLACE INTO Metadata VALUES('summary_last_id', ?)", (last_id,))
+        self.add_count("summaries_updated", len(changed))
+        return len(changed)
+
+    def node_summaries(self, node=None, state=None, cluster=None):
+        """
+        Query the summary cache ordered by cluster and name, history the update has not folded in yet is folded in memory
+        Yields tuples of (nodename, state, comment, since, failures, cluster), failures counts the failures that started this month
+        """
+        this_month = TrackNodes.month_start(time.time())
+        (last_id, changed) = self.fold_summary()
+
+        where = []
+        params = []
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_clause(node))
+            params.append(node)
+        if state is not None:
+            where.append(TrackNodes.state_clause(state))
+
+        query = "SELECT Cluster, Name, State, Comment, Since, Month, Failures FROM NodeSummary"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY Cluster, Name"
+        rows = self.stream_query(query, params)
+
+        if changed:
+            # Read-only connections cannot refresh the cache, merge the folded summaries instead
+            states = None if state is None else TrackNodes.state_filter(state)
+            rows = [row for row in rows if (row[0], row[1]) not in changed]
+            rows.extend(key + summary for (key, summary) in changed.items()
+                        if (cluster is None or key[0] == cluster) and (node is None or fnmatch.fnmatchcase(key[1], node)) and
+                        (states is None or summary[0] in states))
+            rows.sort()
+
+        for (nodecluster, nodename, nodestate, comment, since, month, failures) in rows:
+            yield (nodename, nodestate, comment, since, failures if month == this_month else 0, nodecluster)
+
+    def print_summary(self):
+        """
+        Print the failed nodes of the summary cache to STDOUT
+        """
+        try:
+            print("Summary of Nodes")
+            print("=========")
+            failed = 0
+            month_failures = 0
+            for (nodename, nodestate, comment, since, failures, cluster) in self.node_summaries(node=self.node, state=self.state,
+                                                                                                cluster=self.cluster):
+                month_failures += failures
+                if not nodestate & FAILED_STATES:
+                    continue
+                failed += 1
+                if cluster:
+                    nodename = "%s:%s" % (cluster, nodename)
+                print("%s | %s | since %s | %d failures this month | '%s'" % (nodename, TrackNodes.decode_state(nodestate),
+                                                                               TrackNodes.format_time(since), failures, comment))
+            print("")
+            print("%d failed nodes, %d failures this month" % (failed, month_failures))
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to less and was quit prior to EOF
+                return
+
+    def downtime_seconds(self, node=None, since=None, until=None, cluster=None):
+        """
+        Return {nodename: seconds} failed within the time range, open intervals count until now
+        """
+        since = TrackNodes.parse_time(since)
+        until = TrackNodes.parse_time(until)
+        now = int(time.time())
+        totals = {}
+        for (nodename, start, end, state, comment, nodecluster) in self.downtimes(node=node, since=since, until=until, cluster=cluster):
+            if end is None:
+                end = now
+            if since is not None:
+                start = max(start, since)
+            if until is not None:
+                end = min(end, until)
+            if nodecluster:
+                nodename = "%s:%s" % (nodecluster, nodename)
+            totals[nodename] = totals.get(nodename, 0) + max(0, end - start)
+        return totals
+
+    def print_downtime(self):
+        """
+        Print downtime intervals and the total downtime of each node to STDOUT
+        """
+        try:
+            print("Downtime of Nodes")
+            print("=========")
+            for (nodename, start, end, state, comment, cluster) in self.downtimes(node=self.node, since=self.since, until=self.until,
+                                                                                  state=self.state, cluster=self.cluster):
+                if cluster:
+                    nodename = "%s:%s" % (cluster, nodename)
+                if end is None:
+                    end_text = "ongoing"
+                    duration = int(time.time()) - start
+                else:
+                    end_text = TrackNodes.format_time(end)
+                    duration = end - start
+                print("%s | %s | %s | %s | %s | '%s'" % (nodename, TrackNodes.format_time(start), end_text,
+                                                         TrackNodes.format_duration(duration), TrackNodes.decode_state(state), comment))
+            print("")
+            print("Total Downtime")
+            print("=========")
+            totals = self.downtime_seconds(node=self.node, since=self.since, until=self.until, cluster=self.cluster)
+            for nodename in sorted(totals, key=lambda nodename: (-totals[nodename], nodename)):
+                print("%s | %s" % (nodename, TrackNodes.format_duration(totals[nodename])))
+            print("")
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to less and was quit prior to EOF
+                return
+
+    def search_comments(self, words, node=None, since=None, until=None, cluster=None, limit=None):
+        """
+        Search comments in the history for all of the words, grouped by node and ordered by the summed bm25 rank of the matches
+        Yields tuples of (nodename, matches, time, comment, cluster) with the time and comment of the latest match
+        """
+        where = []
+        params = []
+        if cluster is not None:
+            where.append("s.Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append("s." + TrackNodes.node_id_clause(node))
+            params.append(node)
+        if since is not None:
+            where.append("s.Time>=?")
+            params.append(TrackNodes.parse_time(since))
+        if until is not None:
+            where.append("s.Time<?")
+            params.append(TrackNodes.parse_time(until))
+
+        if self.has_table("NodeComments"):
+            # Quote each word, so punctuation such as in power-fault is not taken as query syntax
+            match = " ".join('"%s"' % word.replace('"', '""') for word in words.split())
+            query = ("SELECT s.Name, COUNT(*), datetime(MAX(s.Time), 'unixepoch'), s.Comment, s.Cluster"
+                     " FROM (SELECT rowid, rank FROM NodeComments WHERE NodeComments MATCH ?) m JOIN NodeStates s ON s.CommentId=m.rowid")
+            order = "SUM(m.rank), MAX(s.Time) DESC"
+            params.insert(0, match)
+        else:
+            query = "SELECT s.Name, COUNT(*), datetime(MAX(s.Time), 'unixepoch'), s.Comment, s.Cluster FROM NodeStates s"
+            for word in words.split():
+                where.insert(0, "s.Comment LIKE ?")
+                params.insert(0, "%" + word + "%")
+            order = "COUNT(*) DESC, MAX(s.Time) DESC"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        # With a single MAX() aggregate sqlite takes s.Comment from the latest matching row
+        query += " GROUP BY s.Cluster, s.Name ORDER BY " + order
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(int(limit))
+        return self.stream_query(query, params)
+
+    def print_changes(self):
+        """
+        Print the changes after the cursor to STDOUT, followed by the cursor to pass to the next --changes
+        """
+        if re.match(r"^\d+$", str(self.changes)):
+            (cursor, since) = (int(self.changes), None)
+        else:
+            (cursor, since) = (None, self.changes)
+        # Unless the limit cut the changes short, nothing up to the newest change is left to show, even if filtered out
+        latest = self.latest_cursor()
+        count = 0
+        try:
+            print("Changes of Nodes")
+            print("=========")
+            for (changeid, nodename, nodetime, state, comment, cluster) in self.node_changes(cursor=cursor, since=since, node=self.node,
+                                                                                            state=self.state, limit=self.limit,
+                                                                                            cluster=self.cluster):
+                count += 1
+                cursor = changeid
+                if cluster:
+                    nodename = "%s:%s" % (cluster, nodename)
+                print("%d | %s | %s | %s | '%s'" % (changeid, nodename, TrackNodes.format_time(nodetime),
+                                                     TrackNodes.decode_state(state), comment))
+            if self.limit is None or count < int(self.limit):
+                cursor = max(cursor or 0, latest)
+            print("")
+            print("cursor: %d" % cursor)
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to less and was quit prior to EOF
+                return
+
+    def current_failed_nodes(self, node=None, state=None, cluster=None):
+        """
+        Query the currently failed nodes ordered by cluster and name
+        Yields tuples of (nodename, state, comment, cluster)
+        """
+        where = []
+        params = []
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_clause(node))
+            params.append(node)
+        if state is not None:
+            where.append(TrackNodes.state_clause(state))
+
+        query = "SELECT Name, State, Comment, Cluster FROM CurrentFailedNodes"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY Cluster, Name"
+        return self.stream_query(query, params)
+
+    def export_rows(self, out=None):
+        """
+        Write the filtered history, or the currently failed nodes, to out as csv or jsonl
+        Rows are streamed from sqlite and written in chunks of HISTORY_BATCH_SIZE, so memory does not grow with the export
+        """
+        if out is None:
+            out = sys.stdout
+        if self.current:
+            fields = ["cluster", "node", "state", "comment"]
+            rows = ((cluster, nodename, TrackNodes.decode_state(state), comment)
+                    for (nodename, state, comment, cluster) in self.current_failed_nodes(node=self.node, state=self.state,
+                                                                                         cluster=self.cluster))
+        else:
+            fields = ["cluster", "node", "time", "state", "comment"]
+            rows = ((cluster, nodename, nodetime, TrackNodes.decode_state(state), comment)
+                    for (nodename, nodetime, state, comment, cluster) in self.history(node=self.node, since=self.since, until=self.until,
+                                                                                      state=self.state, limit=self.limit,
+                                                                                      cluster=self.cluster, archive=self.archive))
+
+        if self.export == "csv":
+            writer = csv.writer(out)
+            writer.writerow(fields)
+        while True:
+            chunk = list(itertools.islice(rows, HISTORY_BATCH_SIZE))
+            if not chunk:
+                break
+            if self.export == "csv":
+                writer.writerows(chunk)
+            else:
+                out.write("".join(json.dumps(dict(zip(fields, row)), sort_keys=True) + "\n" for row in chunk))
+
+    def print_export(self):
+        """
+        Export to STDOUT
+        """
+        try:
+            self.export_rows()
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to head and was quit prior to EOF
+                return
+
+    def print_search(self):
+        """
+        Print nodes with comments matching the search to STDOUT
+        """
+        try:
+            print("Search Results")
+            print("=========")
+            for (nodename, matches, nodetime, comment, cluster) in self.search_comments(self.search, node=self.node, since=self.since,
+                                                                                         until=self.until, cluster=self.cluster, limit=self.limit):
+                if cluster:
+                    nodename = "%s:%s" % (cluster, nodename)
+                print("%s | %d matches | %s | '%s'" % (nodename, matches, nodetime, comment))
+            print("")
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to less and was quit prior to EOF
+                return
+
+    def availability(self, node=None, since=None, until=None, cluster=None):
+        """
+        Compute availability statistics over a time range, aggregated by sqlite from the Downtimes table
+        Returns a dict with the cluster wide statistics, "states" with downtime per state bit and "nodes" with per node statistics
+        """
+        now = int(time.time())
+        until = TrackNodes.parse_time(until)
+        if until is None or until > now:
+            until = now
+        since = TrackNodes.parse_time(since)
+        if since is None:
+            since = until - REPORT_DAYS * 86400
+        window = max(1, until - since)
+
+        where = ["Start<?", "(End IS NULL OR End>?)"]
+        params = [until, since]
+        if cluster is not None:
+            where.append("Cluster=?")
+            params.append(cluster)
+        if node is not None:
+            where.append(TrackNodes.node_clause(node))
+            params.append(node)
+        # Length of each outage clipped to the time range, outages still open last until now
+        clipped = "MIN(IFNULL(End, %d), %d) - MAX(Start, %d)" % (now, until, since)
+
+        # Nodes are only known to tracknodes once they failed, so all nodes ever failed are counted
+        query = "SELECT COUNT(*) FROM (SELECT DISTINCT Cluster, Name FROM Downtimes"
+        if len(where) > 2:
+            query += " WHERE " + " AND ".join(where[2:])
+        self.cur.execute(query + ")", params[2:])
+        total_nodes = self.cur.fetchone()[0]
+
+        # One pass over the DowntimesReport index, folded into per node and per state totals
+        nodes = {}
+        by_state = {}
+        self.cur.execute("SELECT Cluster, Name, State, COUNT(*), SUM(%s) FROM Downtimes WHERE %s GROUP BY Cluster, Name, State" % (clipped, " AND ".join(where)), params)
+        for (nodecluster, nodename, state, outages, downtime) in self.cur:
+            if nodecluster:
+                nodename = "%s:%s" % (nodecluster, nodename)
+            node_totals = nodes.setdefault(nodename, [0, 0])
+            node_totals[0] += outages
+            node_totals[1] += downtime
+            state_totals = by_state.setdefault(state, [0, 0])
+            state_totals[0] += outages
+            state_totals[1] += downtime
+
+        states = []
+        for bit in [1, 2, 4, 8, 16, 32, 64, 128, 1024]:
+            outages = sum(by_state[state][0] for state in by_state if state & bit)
+            if outages:
+                states.append({"state": TrackNodes.decode_state(bit), "outages": outages,
+                               "downtime": sum(by_state[state][1] for state in by_state if state & bit)})
+
+        nodes = [TrackNodes.availability_stats(window, outages, downtime, name=nodename) for (nodename, (outages, downtime)) in nodes.items()]
+        # Most outages first, then longest downtime
+        nodes.sort(key=lambda stats: (-stats["outages"], -stats["downtime"], stats["name"]))
+
+        stats = TrackNodes.availability_stats(window * max(1, total_nodes), sum(n["outages"] for n in nodes),
+                                              sum(n["downtime"] for n in nodes))
+        stats.update({"since": since, "until": until, "nodes_total": total_nodes, "nodes_failed": len(nodes),
+                      "states": states, "nodes": nodes})
+        return stats
+
+    @staticmethod
+    def availability_stats(window, outages, downtime, name=None):
+        """
+        Availability percentage, mean time between failures and mean time to repair from the downtime in a window of node seconds
+        """
+        stats = {"outages": outages, "downtime": downtime, "availability": 100.0 * (window - downtime) / window,
+                 "mtbf": None, "mttr": None}
+        if name is not None:
+            stats["name"] = name
+        if outages:
+            stats["mtbf"] = (window - downtime) // outages
+            stats["mttr"] = downtime // outages
+        return stats
+
+    def print_report(self):
+        """
+        Print an availability report to STDOUT
+        """
+        def duration(seconds):
+            if seconds is None:
+                return "-"
+            return TrackNodes.format_duration(seconds)
+
+        try:
+            stats = self.availability(node=self.node, since=self.since, until=self.until, cluster=self.cluster)
+            print("Availability Report")
+            print("=========")
+            print("Window | %s - %s" % (TrackNodes.format_time(stats["since"]), TrackNodes.format_time(stats["until"])))
+            print("Nodes | %d" % stats["nodes_total"])
+            print("Nodes Failed | %d" % stats["nodes_failed"])
+            print("Availability | %.3f%%" % stats["availability"])
+            print("Outages | %d" % stats["outages"])
+            print("Downtime | %s" % duration(stats["downtime"]))
+            print("MTBF | %s" % duration(stats["mtbf"]))
+            print("MTTR | %s" % duration(stats["mttr"]))
+            print("")
+            print("Downtime by State")
+            print("=========")
+            for state in stats["states"]:
+                print("%s | %d outages | %s" % (state["state"], state["outages"], duration(state["downtime"])))
+            print("")
+            print("Recurring Offenders")
+            print("=========")
+            limit = self.limit
+            if limit is None:
+                limit = REPORT_OFFENDERS
+            for node in stats["nodes"][:limit]:
+                print("%s | %d outages | %s | %.3f%% | MTBF %s | MTTR %s" % (node["name"], node["outages"], duration(node["downtime"]),
+                                                                              node["availability"], duration(node["mtbf"]), duration(node["mttr"])))
+            print("")
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                # Perhaps output was piped to less and was quit prior to EOF
+                return
+
+    @staticmethod
+    def format_time(seconds):
+        """
+        Format seconds since the epoch as ISO8601 UTC text, as stored in the history
+        """
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(seconds))
+
+    @staticmethod
+    def format_duration(seconds):
+        """
+        Format a number of seconds as [Nd ]HH:MM:SS
+        """
+        days, seconds = divmod(int(seconds), 86400)
+        text = "%02d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+        if days:
+            text = "%dd %s" % (days, text)
+        return text
 
     def print_history(self):
         """
@@ -335,10 +2555,20 @@ class TrackNodes:
         try:
             print("History of Nodes")
             print("=========")
-            self.cur.execute("SELECT * FROM NodeStates ORDER BY datetime(Time) DESC")
-            rows = self.cur.fetchall()
-            for row in rows:
-                print("%s | %s | %s | '%s'" % (row[0], row[3], TrackNodes.decode_state(row[1]), row[2]))
+            rows = self.history(node=self.node, since=self.since, until=self.until, state=self.state, limit=self.limit,
+                                cluster=self.cluster, archive=self.archive)
+            # Nodes changed by the same update to the same state and comment print as one hostlist
+            for (nodetime, group) in itertools.groupby(rows, key=lambda row: row[1]):
+                group = list(group)
+                if len(group) == 1:
+                    (nodename, nodetime, state, comment, cluster) = group[0]
+                    if cluster:
+                        nodename = "%s:%s" % (cluster, nodename)
+                    print("%s | %s | %s | '%s'" % (nodename, nodetime, TrackNodes.decode_state(state), comment))
+                    continue
+                for (hostlist, state, comment) in TrackNodes.group_hostlists((nodename, state, comment, cluster)
+                                                                             for (nodename, nodetime, state, comment, cluster) in group):
+                    print("%s | %s | %s | '%s'" % (hostlist, nodetime, TrackNodes.decode_state(state), comment))
             print("")
         except IOError as e:
             if e.errno == errno.EPIPE:
@@ -349,21 +2579,225 @@ class TrackNodes:
         """
         Close sqlite connection
         """
-        if self.con:
+        if self.con and not self.shared_con:
             self.con.close()
+        self.unlock_updates()
+
+    def update_cycle(self):
+        """
+        Get latest node information and update the database, per cycle state is reset so this can be called repeatedly
+        Returns False if the cycle failed for a cluster and its database records were not updated
+        """
+        if self.clusters:
+            collectors = self.clusters
+        else:
+            collectors = [self]
+
+        if len(collectors) == 1:
+            errors = [collectors[0].collect()]
+        else:
+            # Only updates of several clusters need the threads
+            from multiprocessing.pool import ThreadPool
+
+            # Poll the clusters in parallel, the nodes commands spend their time waiting on the servers
+            pool = ThreadPool(len(collectors))
+            try:
+                errors = pool.map(TrackNodes.collect, collectors)
+            finally:
+                pool.close()
+                pool.join()
+
+        # Only this thread writes to the database, one transaction per cluster
+        updated = True
+        for (collector, error) in zip(collectors, errors):
+            if error is None:
+                collector.update_nodes()
+            else:
+                # Output is incomplete, updating would wrongly mark the missing nodes as online
+                collector.record_failed_update(error)
+                updated = False
+
+        with self.timed_phase("summary"):
+            with self.con:
+                self.refresh_summary()
+        with self.timed_phase("checkpoint"):
+            self.checkpoint_failed_nodes()
+        with self.timed_phase("compact_history"):
+            self.compact_history()
+        self.add_count("update_success", int(updated))
+        return updated
+
+    def write_metrics(self):
+        """
+        Write the timings and counts collected since the last write to the metrics file and reset them
+        The file is replaced atomically so the Prometheus node exporter never reads a partial file
+        """
+        collectors = [collector for collector in self.clusters if collector is not self]
+        if self.metrics is not None:
+            metrics_format = self.metrics_format
+            if metrics_format is None:
+                metrics_format = "prometheus" if self.metrics.endswith(".prom") else "json"
+
+            if metrics_format == "prometheus":
+                data = self.prometheus_metrics(collectors)
+            else:
+                data = {"time": int(time.time()), "phases": self.phase_seconds, "counts": self.counts,
+                        "clusters": dict((collector.cluster, {"phases": collector.phase_seconds, "counts": collector.counts})
+                                         for collector in collectors)}
+                data = json.dumps(data, indent=2, sort_keys=True) + "\n"
+
+            with open(self.metrics + ".tmp", "w") as f:
+                f.write(data)
+            os.rename(self.metrics + ".tmp", self.metrics)
+
+        for tn in [self] + collectors:
+            tn.phase_seconds = {}
+            tn.counts = {}
+
+    def prometheus_metrics(self, collectors):
+        """
+        Format the timings and counts in the Prometheus text exposition format, clusters are labeled
+        """
+        def labels(cluster, **extra):
+            pairs = []
+            if cluster is not None:
+                pairs.append(("cluster", cluster))
+            pairs.extend(sorted(extra.items()))
+            if not pairs:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                                     for (key, value) in pairs)
+
+        sources = [(None, self)] + [(collector.cluster, collector) for collector in collectors]
+        lines = ["# HELP tracknodes_phase_seconds Seconds spent in each phase of the last update",
+                 "# TYPE tracknodes_phase_seconds gauge"]
+        for (cluster, tn) in sources:
+            for phase in sorted(tn.phase_seconds):
+                lines.append("tracknodes_phase_seconds%s %f" % (labels(cluster, phase=phase), tn.phase_seconds[phase]))
+        names = sorted(set(name for (cluster, tn) in sources for name in tn.counts))
+        for name in names:
+            lines.append("# HELP tracknodes_%s Count of %s in the last update" % (name, name.replace("_", " ")))
+            lines.append("# TYPE tracknodes_%s gauge" % name)
+            for (cluster, tn) in sources:
+                if name in tn.counts:
+                    lines.append("tracknodes_%s%s %d" % (name, labels(cluster), tn.counts[name]))
+        lines.append("# HELP tracknodes_last_update_timestamp_seconds Time the metrics were written")
+        lines.append("# TYPE tracknodes_last_update_timestamp_seconds gauge")
+        lines.append("tracknodes_last_update_timestamp_seconds %d" % int(time.time()))
+        return "\n".join(lines) + "\n"
+
+    def collect(self):
+        """
+        Reset per cycle state and parse the nodes command, does not use the database so it can run in a worker thread
+        Returns None on success or the reason the nodes command failed
+        """
+        self.current_failed = []
+        self.current_activity = {} if self.full else None
+        self.onlined_nodes = []
+        try:
+            with self.timed_phase("parse_nodes_cmd"):
+                self.parse_nodes_cmd()
+        except (NodesCmdTimeout, NodesCmdError, OSError, ValueError) as e:
+            # ValueError is incomplete structured output
+            return str(e)
+        self.add_count("nodes_parsed", len(self.current_failed) + len(self.current_activity or {}))
+        return None
+
+    def record_failed_update(self, reason):
+        """
+        Record an update cycle that could not be completed
+        """
+        sys.stderr.write("Update failed: %s\n" % reason)
+        with self.con:
+            self.cur.execute("INSERT INTO FailedUpdates(Time, Reason, Cluster) VALUES(?, ?, ?)", (int(time.time()), reason, self.cluster or ''))
+
+    def stop(self, signum=None, frame=None):
+        """
+        Stop the daemon after the current cycle, used as the SIGTERM and SIGINT handler
+        """
+        if self.verbose:
+            print("Stopping daemon")
+        self.running = False
+
+    def run_daemon(self):
+        """
+        Update the database every interval seconds reusing the database connection and detected nodes command
+        """
+        orig_handlers = {}
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            orig_handlers[signum] = signal.signal(signum, self.stop)
+
+        self.running = True
+        try:
+            next_cycle = time.time()
+            while self.running:
+                try:
+                    self.update_cycle()
+                except Exception as e:
+                    # A failed cycle, such as the nodes command erroring, should not stop tracking
+                    sys.stderr.write("Update failed: %s\n" % e)
+                    self.counts["update_success"] = 0
+                self.write_metrics()
+
+                # Schedule from the start of the cycle so slow updates do not drift, skip missed cycles
+                next_cycle += self.interval
+                now = time.time()
+                if next_cycle < now:
+                    next_cycle = now
+                # Sleep in short steps so a signal stops the daemon promptly
+                while self.running and time.time() < next_cycle:
+                    time.sleep(min(1.0, max(0.0, next_cycle - time.time())))
+        finally:
+            self.running = False
+            for signum in orig_handlers:
+                signal.signal(signum, orig_handlers[signum])
 
     def run(self):
-        self.find_nodes_cmd()
+        # Locked before connecting, so only one update at a time creates or migrates the database
+        if (self.update or self.daemon) and not self.lock_updates():
+            if self.daemon:
+                raise Exception("Another tracknodes update or daemon is running for dbfile: %s" % self.dbfile)
+            # The running update records the same node states, so this one is skipped
+            sys.stderr.write("Another tracknodes update is running for dbfile: %s, skipping update\n" % self.dbfile)
+            self.update = False
 
-        self.connect_db()
+        self.connect_db(readonly=not (self.update or self.daemon))
+
+        # Only the update needs the resource manager, queries just read the database
+        if self.update or self.daemon:
+            self.find_clusters_cmds()
+
+        if self.daemon:
+            self.run_daemon()
+            return
 
         # Get Latest Node Information, Update Database
         if self.update:
-            self.parse_nodes_cmd()
-            self.online_nodes()
-            self.fail_nodes()
+            self.update_cycle()
 
-        self.print_history()
+        if self.export is not None:
+            self.print_export()
+        elif self.at is not None:
+            self.print_failed_at()
+        elif self.flaps:
+            self.print_flaps()
+        elif self.summary:
+            self.print_summary()
+        elif self.changes is not None:
+            self.print_changes()
+        elif self.search is not None:
+            self.print_search()
+        elif self.report:
+            self.print_report()
+        elif self.downtime:
+            self.print_downtime()
+        else:
+            with self.timed_phase("print_history"):
+                self.print_history()
+
+        # The metrics describe the update, queries must not replace them
+        if self.update:
+            self.write_metrics()
 
 if __name__ == "__main__":
     """ EntryPoint Of Application if used as standalone file """
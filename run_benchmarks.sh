@@ -0,0 +1,4 @@
+#!/bin/bash
+# Compare against an earlier run: ./run_benchmarks.sh -o new.json -c old.json
+export PYTHONPATH="${PYTHONPATH}:./lib/"
+python test/benchmarks/benchmark.py "$@"
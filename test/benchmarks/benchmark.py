@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+""" Benchmarks of tracknodes on synthetic clusters
+
+Generates pbsnodes (Torque, PBSpro) and sinfo (SLURM) output for clusters of
+1k, 10k and 100k failed nodes and histories with millions of transitions, then
+times parsing, updating and querying. Results are written as JSON so runs of
+different commits can be compared with --compare.
+"""
+
+import json
+import optparse
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "lib"))
+from tracknodes.tracknodes import TrackNodes
+
+COMMENTS = ["bad DIMM", "power fault", "failed disk", "DIMM Configuration Error", "node health check failed", ""]
+STATES = ["offline", "down", "offline,down", "state-unknown,down", "offline,job-exclusive"]
+
+
+def nodename(i):
+    """ Synthetic node name, racks of 480 nodes """
+    return "r%dn%03d" % (i // 480 + 1, i % 480 + 1)
+
+
+def pbsnodes_output(nodes, seed=0):
+    """ Output of pbsnodes -nl (Torque) or pbsnodes -l (PBSpro) listing nodes failed """
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(nodes):
+        comment = rnd.choice(COMMENTS)
+        lines.append("%-20s %-26s %s" % (nodename(i), rnd.choice(STATES), comment))
+    return "\n".join(lines) + "\n"
+
+
+def sinfo_output(nodes, seed=0):
+    """ Output of sinfo -dR listing nodes down """
+    rnd = random.Random(seed)
+    lines = ["REASON               USER      TIMESTAMP           NODELIST"]
+    for i in range(nodes):
+        comment = rnd.choice(COMMENTS) or "not responding"
+        lines.append("%-20s root      2017-01-02T09:09:02 %s" % (comment, nodename(i)))
+    return "\n".join(lines) + "\n"
+
+
+def fake_nodes_cmd(tmpdir, name, output):
+    """ Write an executable named like the real command that prints output, so parsing includes reading the pipe """
+    bindir = tempfile.mkdtemp(dir=tmpdir)
+    outfile = os.path.join(bindir, "output.txt")
+    with open(outfile, "w") as f:
+        f.write(output)
+    cmd = os.path.join(bindir, name)
+    with open(cmd, "w") as f:
+        f.write("#!/bin/sh\nexec cat '%s'\n" % outfile)
+    os.chmod(cmd, 0o755)
+    return cmd
+
+
+def history_rows(transitions, nodes, seed=0):
+    """ Yield NodeStates rows for a history of failures and recoveries, one minute apart """
+    rnd = random.Random(seed)
+    start = int(time.time()) - transitions * 60
+    failed = set()
+    for i in range(transitions):
+        node = rnd.randrange(nodes)
+        if node in failed:
+            failed.discard(node)
+            yield (nodename(node), 0, "", start + i * 60)
+        else:
+            failed.add(node)
+            yield (nodename(node), TrackNodes.encode_state(rnd.choice(STATES)), rnd.choice(COMMENTS), start + i * 60)
+
+
+def timed(func, repeat):
+    """ Best wall clock time of func over repeat runs, setup is done by func returning a callable """
+    best = None
+    for _ in range(repeat):
+        run = func()
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+class Benchmark(object):
+    """ Runs the benchmarks in a temporary directory """
+
+    def __init__(self, sizes, transitions, repeat, verbose=False):
+        self.sizes = sizes
+        self.transitions = transitions
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = {}
+        self.tmpdir = None
+
+    def record(self, name, seconds):
+        self.results[name] = seconds
+        if self.verbose:
+            print("%-40s %10.4fs" % (name, seconds))
+
+    def tracknodes(self, dbname, **kwargs):
+        tn = TrackNodes(dbfile=os.path.join(self.tmpdir, dbname), **kwargs)
+        tn.connect_db()
+        return tn
+
+    def bench_parse(self, nodes):
+        for (resourcemanager, name, output) in [("torque", "pbsnodes", pbsnodes_output(nodes)),
+                                                ("pbspro", "pbsnodes", pbsnodes_output(nodes)),
+                                                ("slurm", "sinfo", sinfo_output(nodes))]:
+            cmd = fake_nodes_cmd(self.tmpdir, name, output)
+
+            def setup():
+                tn = TrackNodes(nodes_cmd=cmd)
+                tn.resourcemanager = resourcemanager
+                return tn.parse_nodes_cmd
+            self.record("parse_nodes_cmd.%s.%d" % (resourcemanager, nodes), timed(setup, self.repeat))
+
+    def bench_update(self, nodes):
+        rnd = random.Random(nodes)
+        failed = [(nodename(i), 3, rnd.choice(COMMENTS)) for i in range(nodes)]
+        # Half of the nodes recover, as many new nodes fail and a tenth of the remaining change comment
+        churned = [(name, state, comment + " again" if i % 10 == 0 else comment) for (i, (name, state, comment)) in enumerate(failed[nodes // 2:])]
+        churned += [(nodename(i), 2, "power fault") for i in range(nodes, nodes + nodes // 2)]
+
+        counter = [0]
+
+        def fresh_db():
+            counter[0] += 1
+            return self.tracknodes("update.%d.%d.db" % (nodes, counter[0]))
+
+        def setup_fail():
+            tn = fresh_db()
+            tn.current_failed = failed
+
+            def run():
+                tn.update_nodes()
+                tn.con.close()
+                tn.con = None
+            return run
+        self.record("update_nodes.fail.%d" % nodes, timed(setup_fail, self.repeat))
+
+        def setup_churn():
+            tn = fresh_db()
+            tn.current_failed = failed
+            tn.update_nodes()
+            tn.current_failed = churned
+
+            def run():
+                tn.update_nodes()
+                tn.con.close()
+                tn.con = None
+            return run
+        self.record("update_nodes.churn.%d" % nodes, timed(setup_churn, self.repeat))
+
+    def bench_history(self):
+        nodes = max(self.sizes)
+        tn = self.tracknodes("history.db")
+        rows = history_rows(self.transitions, nodes)
+        while True:
+            batch = [row for (_, row) in zip(range(100000), rows)]
+            if not batch:
+                break
+            tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)", batch)
+        tn.con.commit()
+
+        devnull = open(os.devnull, "w")
+        for (name, filters) in [("all", {}), ("node", {"node": nodename(1)}), ("glob", {"node": "r1n*"}),
+                                ("limit", {"limit": 100}), ("state", {"state": "offline,down", "limit": 1000})]:
+            def setup():
+                for attr in ["node", "since", "until", "state", "limit"]:
+                    setattr(tn, attr, filters.get(attr))
+
+                def run():
+                    orig_stdout = sys.stdout
+                    sys.stdout = devnull
+                    try:
+                        tn.print_history()
+                    finally:
+                        sys.stdout = orig_stdout
+                return run
+            self.record("print_history.%s.%d" % (name, self.transitions), timed(setup, self.repeat))
+        devnull.close()
+        tn.con.close()
+        tn.con = None
+
+    def run(self):
+        self.tmpdir = tempfile.mkdtemp()
+        try:
+            for nodes in self.sizes:
+                self.bench_parse(nodes)
+                self.bench_update(nodes)
+            if self.transitions:
+                self.bench_history()
+        finally:
+            shutil.rmtree(self.tmpdir)
+        return self.results
+
+
+def git_revision():
+    """ Commit the benchmarks ran against, if run from a git checkout """
+    try:
+        return subprocess.Popen(["git", "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True).communicate()[0].strip()
+    except OSError:
+        return ""
+
+
+def compare(baseline, results, threshold):
+    """ Print each benchmark against the baseline, returns the names of benchmarks slower than threshold times the baseline """
+    regressions = []
+    print("%-40s %10s %10s %8s" % ("benchmark", baseline.get("revision", "baseline"), "current", "ratio"))
+    for name in sorted(results):
+        if name not in baseline["results"]:
+            print("%-40s %10s %10.4f %8s" % (name, "-", results[name], "-"))
+            continue
+        ratio = results[name] / max(baseline["results"][name], 1e-9)
+        flag = ""
+        if ratio > threshold:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print("%-40s %10.4f %10.4f %7.2fx%s" % (name, baseline["results"][name], results[name], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--sizes", dest="sizes", default="1000,10000,100000",
+                      help="Comma separated numbers of failed nodes, default 1000,10000,100000")
+    parser.add_option("-t", "--transitions", dest="transitions", type="int", default=1000000,
+                      help="Number of transitions in the history queried, 0 skips history benchmarks, default 1000000")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                      help="Runs of each benchmark, the best time is kept, default 3")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Write results as JSON to OUTPUT")
+    parser.add_option("-c", "--compare", dest="compare", default=None,
+                      help="Compare with results written by an earlier --output")
+    parser.add_option("--threshold", dest="threshold", type="float", default=1.25,
+                      help="Ratio to the baseline reported as a regression, default 1.25")
+    (options, args) = parser.parse_args()
+
+    sizes = [int(size) for size in options.sizes.split(",")]
+    results = Benchmark(sizes, options.transitions, options.repeat, verbose=options.compare is None).run()
+    report = {"revision": git_revision(), "python": platform.python_version(), "results": results}
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,34 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+import benchmark
+from tracknodes.tracknodes import TrackNodes
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_synthetic_outputs_parse(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            parsed = []
+            for (resourcemanager, name, output) in [("torque", "pbsnodes", benchmark.pbsnodes_output(1000)),
+                                                    ("slurm", "sinfo", benchmark.sinfo_output(1000))]:
+                tn = TrackNodes(nodes_cmd=benchmark.fake_nodes_cmd(tmpdir, name, output))
+                tn.resourcemanager = resourcemanager
+                tn.parse_nodes_cmd()
+                parsed.append(tn.current_failed)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        assert( [len(current_failed) for current_failed in parsed] == [1000, 1000] )
+        assert( parsed[0][481][0] == "r2n002" and parsed[1][481][0] == "r2n002" )
+
+    def test_run(self):
+        results = benchmark.Benchmark([50], 1000, 1).run()
+
+        assert( "parse_nodes_cmd.pbspro.50" in results and "update_nodes.churn.50" in results )
+        assert( "print_history.all.1000" in results and all(seconds >= 0 for seconds in results.values()) )
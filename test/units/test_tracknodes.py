@@ -1,8 +1,17 @@
 import nose
 import mock
 import unittest
+import json
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
 import sys
-import types
+import tempfile
+import time
+import zlib
+import tracknodes.tracknodes
 from tracknodes.tracknodes import TrackNodes
 
 try:
@@ -12,7 +21,18 @@ except ImportError:
 
 
 class mock_Popen(object):
-    pass
+    def __init__(self, stdout=""):
+        self.stdout = StringIO(stdout)
+        self.returncode = 0
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+    def kill(self):
+        pass
 
 class ContextualStringIO(StringIO):
     def __enter__(self):
@@ -21,26 +41,79 @@ class ContextualStringIO(StringIO):
         self.close() # icecrime does it, so I guess I should, too
         return False # Indicate that we haven't handled the exception, if received
 
-def mock_communicate_sinfo(self):
-    return ("\nbroken ram root 2017-01-02T09:09:82 n010\n", "")
+mock_stdout_sinfo = "\nbroken ram root 2017-01-02T09:09:82 n010\n"
+
+# pbsnodes --version of Torque, to stderr, and of PBSpro, to stdout
+pbsnodes_torque_version = "echo 'Version: 12' >&2\n"
+
+mock_stdout_torque_example1 = "n0294                offline                    other new new notes power fault 20161119\n"
 
-def mock_communicate_torque_version(self):
-    return ("", "Version: 12\n")
+mock_stdout_pbsnodes_json = """{
+    "timestamp":1483347600,
+    "pbs_version":"19.1.3",
+    "nodes":{
+        "n001":{
+            "Mom":"n001",
+            "state":"free",
+            "resources_available":{"ncpus":36}
+        },
+        "n002":{
+            "state":"job-exclusive",
+            "jobs":["1.pbs/0"]
+        },
+        "n003":{
+            "state":"offline,down",
+            "comment":"power fault"
+        }
+    }
+}
+"""
 
-def mock_communicate_torque_example1(self):
-    return ("n0294                offline                    other new new notes power fault 20161119\n", "")
+pbsnodes_pbspro_version = "echo 'pbs_version = 14.1.0'\n"
 
-def mock_communicate_pbspro_version(self):
-    return ("pbs_version = 14.1.0\n", "\n")
+def write_pbsnodes(tmpdir, script):
+    """ Write a pbsnodes script to tmpdir and return its path """
+    pbsnodes = os.path.join(tmpdir, "pbsnodes")
+    with open(pbsnodes, "w") as f:
+        f.write("#!/bin/sh\n" + script)
+    os.chmod(pbsnodes, 0o755)
+    return pbsnodes
 
 
 class TestTrackNodes(unittest.TestCase):
 
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tmpdir, "tracknodes.db")
+        self.instances = []
+
+    def tearDown(self):
+        for tn in self.instances:
+            if tn.con is not None:
+                tn.con.close()
+        shutil.rmtree(self.tmpdir)
+
+    def new_tracknodes(self, **kwargs):
+        """ TrackNodes on the test database, closed in tearDown """
+        kwargs.setdefault("dbfile", self.dbfile)
+        tn = TrackNodes(**kwargs)
+        self.instances.append(tn)
+        return tn
+
+    def connect(self, **kwargs):
+        tn = self.new_tracknodes(**kwargs)
+        tn.connect_db()
+        return tn
+
     def test_encode_state(self):
         assert( TrackNodes.encode_state("offline,down") == 3 )
+        assert( TrackNodes.encode_state("state-unknown,down") == 130 and TrackNodes.encode_state("free") == 0 )
+        assert( TrackNodes.encode_state("job-exclusive") == 8 and TrackNodes.encode_state("sleeping") == 1024 )
 
     def test_decode_state(self):
         assert( TrackNodes.decode_state(3) == "offline,down" )
+        assert( TrackNodes.decode_state(0) == "online" and TrackNodes.decode_state(1024 | 128 | 4) == "reserve,state-unknown,undetected-state" )
+        assert( TrackNodes.decode_state(2 | 512) == "down" )
 
     def test_which_shortpath(self):
         full_env_path = TrackNodes.which("env")
@@ -88,13 +161,13 @@ class TestTrackNodes(unittest.TestCase):
 
         print(out.getvalue())
 
-        assert( "Resource Manager Detected" in out.getvalue() )
+        # Queries never detect the resource manager
+        assert( "dbfile:" in out.getvalue() and "Resource Manager Detected" not in out.getvalue() )
 
     @mock.patch('tracknodes.tracknodes.Popen')
     @mock.patch('tracknodes.tracknodes.TrackNodes.which', return_value="sinfo")
     def test_run_update(self, mock_which, mock_popen):
-        mock_popen.return_value = mock_Popen()
-        mock_popen.return_value.communicate = types.MethodType(mock_communicate_sinfo, mock_popen.return_value)
+        mock_popen.return_value = mock_Popen(mock_stdout_sinfo)
 
         out = StringIO()
         orig_stdout = sys.stdout
@@ -110,6 +183,82 @@ class TestTrackNodes(unittest.TestCase):
 
         assert( "| down | 'broken ram'" in out.getvalue() )
 
+    @mock.patch('tracknodes.tracknodes.Popen')
+    def test_parse_sinfo_hostlist(self, mock_popen):
+        mock_popen.return_value = mock_Popen("REASON USER TIMESTAMP NODELIST\n"
+                                             "rack power root 2017-01-02T09:09:02 r1n[001-003,010],login1\n"
+                                             "bad DIMM root 2017-01-02T09:09:02 n[07-08]\n"
+                                             "broken root 2017-01-02T09:09:02 r1n[001-\n")
+        tn = TrackNodes(nodes_cmd="sinfo")
+        tn.resourcemanager = "slurm"
+        tn.parse_nodes_cmd()
+
+        assert( [row[0] for row in tn.current_failed] == ["r1n001", "r1n002", "r1n003", "r1n010", "login1", "n07", "n08"] )
+        assert( tn.current_failed[0][1:] == (2, "rack power") and tn.counts["parse_errors"] == 1 )
+
+    @mock.patch('tracknodes.tracknodes.Popen')
+    def test_parse_full(self, mock_popen):
+        mock_popen.return_value = mock_Popen(mock_stdout_pbsnodes_json)
+        tn = TrackNodes(nodes_cmd="pbsnodes", full=True)
+        tn.resourcemanager = "pbspro"
+        tn.current_activity = {}
+        # Chunks smaller than a node exercise decoding across reads
+        with mock.patch('tracknodes.tracknodes.JSON_CHUNK_SIZE', 7):
+            tn.parse_nodes_cmd()
+        pbspro = (tn.current_failed, tn.current_activity)
+
+        mock_popen.return_value = mock_Popen("n01|allocated|none\nn02|idle|none\nn03|down*|Not responding\n"
+                                             "n04|mixed+drain|bad DIMM\nbroken\n")
+        tn = TrackNodes(nodes_cmd="sinfo", full=True)
+        tn.resourcemanager = "slurm"
+        tn.current_activity = {}
+        tn.parse_nodes_cmd()
+
+        assert( pbspro == ([("n003", 3, "power fault")], {"n001": 0, "n002": 8}) )
+        assert( mock_popen.call_args[0][0][1:] == ["-N", "-h", "-o", "%N|%T|%E"] )
+        assert( tn.current_failed == [("n03", 130, "Not responding"), ("n04", 17, "bad DIMM")] )
+        assert( tn.current_activity == {"n01": 8, "n02": 0} and tn.counts["parse_errors"] == 1 )
+        truncated = TrackNodes.json_object_items(iter([mock_stdout_pbsnodes_json[:150]]), "nodes")
+        self.assertRaises(ValueError, list, truncated)
+
+    def test_activity_nodes(self):
+        tn = self.connect(full=True)
+        cycles = [([("n003", 1, "bad DIMM")], {"n001": 8, "n002": 0}),
+                  ([("n003", 1, "bad DIMM")], {"n001": 8, "n002": 0}),
+                  ([("n001", 2, "power fault")], {"n002": 8, "n003": 8}),
+                  ([], {"n001": 0, "n002": 0, "n003": 8})]
+        rows = []
+        for (cycle, (current_failed, current_activity)) in enumerate(cycles):
+            tn.current_failed = current_failed
+            tn.current_activity = current_activity
+            with mock.patch('tracknodes.tracknodes.time.time', return_value=1000 + cycle * 60):
+                tn.update_nodes()
+            tn.cur.execute("SELECT COUNT(*) FROM NodeStates")
+            rows.append(tn.cur.fetchone()[0])
+        recorded = list(tn.node_changes())
+        tn.cur.execute("SELECT Name, State FROM NodeActivity")
+        activity = tn.cur.fetchall()
+
+        # Only changes are written, n003 comes back busy and n001 fails then comes back free
+        assert( rows == [2, 2, 5, 7] )
+        assert( [change[1:4] for change in recorded] == [("n003", 1000, 1), ("n001", 1000, 8), ("n003", 1120, 8), ("n001", 1120, 2),
+                                                         ("n002", 1120, 8), ("n001", 1180, 0), ("n002", 1180, 0)] )
+        assert( activity == [("n003", 8)] )
+
+    def test_hostlist(self):
+        hostlist = "login1,r1n[001-480,512],r2n[9-12]"
+        nodenames = list(TrackNodes.expand_hostlist(hostlist))
+        grouped = TrackNodes.group_hostlists([("n101", 2, "power", ""), ("n1", 1, "DIMM", "swift"), ("n102", 2, "power", ""),
+                                              ("n2", 1, "DIMM", "swift")])
+
+        assert( len(nodenames) == 486 and nodenames[1:3] == ["r1n001", "r1n002"] and nodenames[-5:] == ["r1n512", "r2n9", "r2n10", "r2n11", "r2n12"] )
+        assert( TrackNodes.compress_hostlist(reversed(nodenames)) == hostlist )
+        assert( list(TrackNodes.expand_hostlist("r[1-2]n[1-2]")) == ["r1n1", "r1n2", "r2n1", "r2n2"] )
+        assert( TrackNodes.compress_hostlist(["n098", "n099", "n100", "gpu"]) == "gpu,n[098-100]" )
+        assert( grouped == [("n[101-102]", 2, "power"), ("swift:n[1-2]", 1, "DIMM")] )
+        for invalid in ["n[1-", "n1]", "n[a-b]"]:
+            self.assertRaises(ValueError, list, TrackNodes.expand_hostlist(invalid))
+
     @mock.patch('tracknodes.tracknodes.TrackNodes.which', return_value="sinfo")
     def test_find_nodes_cmd(self, mock_which):
         tn = TrackNodes()
@@ -118,26 +267,16 @@ class TestTrackNodes(unittest.TestCase):
         print( tn.nodes_cmd )
         assert( tn.nodes_cmd == "sinfo" )
 
-    @mock.patch('tracknodes.tracknodes.Popen')
-    @mock.patch('tracknodes.tracknodes.TrackNodes.which', return_value="pbsnodes")
-    def test_detect_resourcemanager_pbspro(self, mock_which, mock_popen):
-        mock_popen.return_value = mock_Popen()
-        mock_popen.return_value.communicate = types.MethodType(mock_communicate_pbspro_version, mock_popen.return_value)
-
-        tn = TrackNodes(nodes_cmd="pbsnodes")
+    def test_detect_resourcemanager_pbspro(self):
+        tn = TrackNodes(nodes_cmd=write_pbsnodes(self.tmpdir, pbsnodes_pbspro_version))
         tn.detect_resourcemanager()
 
         print( tn.resourcemanager )
 
         assert( tn.resourcemanager == "pbspro" )
 
-    @mock.patch('tracknodes.tracknodes.Popen')
-    @mock.patch('tracknodes.tracknodes.TrackNodes.which', return_value="pbsnodes")
-    def test_detect_resourcemanager_torque(self, mock_which, mock_popen):
-        mock_popen.return_value = mock_Popen()
-        mock_popen.return_value.communicate = types.MethodType(mock_communicate_torque_version, mock_popen.return_value)
-
-        tn = TrackNodes(nodes_cmd="pbsnodes")
+    def test_detect_resourcemanager_torque(self):
+        tn = TrackNodes(nodes_cmd=write_pbsnodes(self.tmpdir, pbsnodes_torque_version))
         tn.detect_resourcemanager()
 
         print( tn.resourcemanager )
@@ -156,8 +295,7 @@ class TestTrackNodes(unittest.TestCase):
 
     @mock.patch('tracknodes.tracknodes.Popen')
     def test_parse_pbsnodes_cmd(self, mock_popen):
-        mock_popen.return_value = mock_Popen()
-        mock_popen.return_value.communicate = types.MethodType(mock_communicate_torque_example1, mock_popen.return_value)
+        mock_popen.return_value = mock_Popen(mock_stdout_torque_example1)
 
         tn = TrackNodes()
         tn.parse_pbsnodes_cmd("-nl")
@@ -167,3 +305,751 @@ class TestTrackNodes(unittest.TestCase):
         print( tn.current_failed[0][0] )
 
         assert ( len(tn.current_failed) == 1 and tn.current_failed[0][0] == "n0294" )
+
+    def test_update_nodes(self):
+        tn = self.connect()
+
+        tn.current_failed = [("n%04d" % i, 2, "bad dimm") for i in range(1000)]
+        tn.update_nodes()
+
+        tn.current_failed = [("n%04d" % i, 2, "bad dimm") for i in range(500, 1000)]
+        tn.current_failed.append(("n0999", 3, "power fault"))
+        tn.current_failed.append(("n1000", 1, "new"))
+        tn.update_nodes()
+
+        last_failed = tn.last_failed_nodes()
+        tn.cur.execute("SELECT COUNT(*) FROM NodeStates WHERE State=0")
+        onlined = tn.cur.fetchone()[0]
+        tn.cur.execute("SELECT COUNT(*) FROM NodeStates")
+        history = tn.cur.fetchone()[0]
+
+        assert ( len(last_failed) == 501 and last_failed["n0999"] == (3, "power fault") )
+        assert ( onlined == 500 and history == 1000 + 500 + 1 + 1 )
+
+    def test_migrate_db(self):
+        con = sqlite3.connect(self.dbfile)
+        con.execute("CREATE TABLE CurrentFailedNodes(Name TEXT, State INT, Comment TEXT)")
+        con.execute("CREATE TABLE NodeStates(Name TEXT, State INT, Comment TEXT, Time TEXT)")
+        con.execute("INSERT INTO NodeStates VALUES('n101', 3, 'bad DIMM', '2016-11-28 20:30:01')")
+        con.execute("INSERT INTO NodeStates VALUES('n101', 0, '', '2016-11-28 21:30:01')")
+        con.commit()
+        con.close()
+
+        tn = self.connect()
+        version = tn.schema_version()
+        tn.cur.execute("SELECT Name, State, Time FROM NodeStates ORDER BY Time")
+        rows = tn.cur.fetchall()
+        tn.cur.execute("EXPLAIN QUERY PLAN SELECT * FROM NodeStates WHERE %s ORDER BY Time DESC" % TrackNodes.node_id_clause("n1*"), ("n1*",))
+        plan = " ".join(str(row[-1]) for row in tn.cur.fetchall())
+
+        assert ( version == tracknodes.tracknodes.SCHEMA_VERSION )
+        assert ( rows == [("n101", 3, 1480365001), ("n101", 0, 1480368601)] )
+        assert ( "sqlite_autoindex_Nodes_1 (Name>? AND Name<?)" in plan and "NodeStatesDataNodeTime (NodeId=?)" in plan )
+
+    def test_migrate_db_failed(self):
+        con = sqlite3.connect(self.dbfile)
+        con.execute("CREATE TABLE CurrentFailedNodes(Name TEXT, State INT, Comment TEXT)")
+        con.execute("CREATE TABLE NodeStates(Name TEXT, State INT, Comment TEXT, Time TEXT)")
+        con.execute("INSERT INTO NodeStates VALUES('n101', 3, 'bad DIMM', '2016-11-28 20:30:01')")
+        con.commit()
+        con.close()
+
+        # Fails after migrate_2 created its tables, nothing of the upgrade may remain
+        tn = self.new_tracknodes()
+        with mock.patch.object(TrackNodes, "migrate_3", side_effect=Exception("disk full")):
+            self.assertRaises(Exception, tn.connect_db)
+        tn.cur.execute("SELECT name FROM sqlite_master WHERE type='table' ORDER BY name")
+        tables = tn.cur.fetchall()
+        failed_version = tn.schema_version()
+        tn.con.close()
+
+        tn = self.connect()
+        version = tn.schema_version()
+        rows = list(tn.history())
+
+        assert( tables == [("CurrentFailedNodes",), ("NodeStates",)] and failed_version == 1 )
+        assert( version == tracknodes.tracknodes.SCHEMA_VERSION and [row[0] for row in rows] == ["n101"] )
+
+    def test_history_filters(self):
+        tn = self.connect()
+        rows = []
+        for i in range(2500):
+            rows.append(("n%04d" % (i % 100), 3, "bad DIMM", 1480000000 + i * 60))
+            rows.append(("n%04d" % (i % 100), 0, "", 1480000000 + i * 60 + 30))
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)", rows)
+        tn.con.commit()
+
+        everything = list(tn.history())
+        limited = list(tn.history(node="n001*", state="offline,down", limit=3))
+        ranged = list(tn.history(node="n0042", since="2016-11-24 15:06:40", until=1480000000 + 1200 * 60))
+
+        assert ( len(everything) == 5000 and everything[0][1] == "2016-11-26 08:46:10" )
+        assert ( limited == [("n0019", "2016-11-26 07:25:40", 3, "bad DIMM", ""),
+                             ("n0018", "2016-11-26 07:24:40", 3, "bad DIMM", ""),
+                             ("n0017", "2016-11-26 07:23:40", 3, "bad DIMM", "")] )
+        assert ( len(ranged) == 24 and ranged[0][0] == "n0042" )
+
+    def test_state_filters(self):
+        tn = self.connect()
+        states = [3, 2, 1, 128 | 2, 4, 0]
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, '', ?)",
+                           [("n%03d" % i, states[i % 6], 1000 + i) for i in range(600)])
+        tn.con.commit()
+
+        down_unknown = list(tn.history(state="down,state-unknown"))
+        reserve_online = set(row[2] for row in tn.history(state="reserve,online"))
+        exact = list(tn.history(state=3))
+        # Common states are found by scanning the history by time, rare ones through the state index
+        common_clause = tn.history_state_clause("down", limit=10)
+        rare_clause = tn.history_state_clause("busy", limit=10)
+        tn.cur.execute("EXPLAIN QUERY PLAN SELECT Name FROM NodeStates WHERE %s ORDER BY Time DESC" % rare_clause)
+        plan = " ".join(str(row[-1]) for row in tn.cur.fetchall())
+
+        assert( len(down_unknown) == 300 and set(row[2] for row in down_unknown) == set([3, 2, 130]) )
+        assert( reserve_online == set([4, 0]) and len(exact) == 100 )
+        # Every valid combination of state bits with busy
+        busy = [value for value in range(2048) if value & 32 and not value & ~1279]
+        assert( common_clause.startswith("+State IN (") and rare_clause == "State IN (%s)" % ",".join(str(value) for value in busy) )
+        assert( "NodeStatesDataStateTime (State=?)" in plan )
+        self.assertRaises(Exception, TrackNodes.state_filter, "sleeping")
+
+    @mock.patch('tracknodes.tracknodes.Popen', side_effect=OSError("pbsnodes not installed"))
+    @mock.patch('tracknodes.tracknodes.TrackNodes.which', return_value=None)
+    def test_run_readonly(self, mock_which, mock_popen):
+        self.new_tracknodes().connect_db()
+
+        out = StringIO()
+        orig_stdout = sys.stdout
+        sys.stdout = out
+
+        tn = self.new_tracknodes()
+        tn.run()
+
+        sys.stdout = orig_stdout
+
+        try:
+            tn.cur.execute("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES('n101', 0, '', 0)")
+            readonly = False
+        except sqlite3.OperationalError:
+            readonly = True
+
+        assert( "History of Nodes" in out.getvalue() )
+        assert( readonly and tn.resourcemanager is None and not mock_popen.called )
+
+    @mock.patch('tracknodes.tracknodes.Popen', wraps=tracknodes.tracknodes.Popen)
+    def test_detect_resourcemanager_cached(self, mock_popen):
+        pbsnodes = write_pbsnodes(self.tmpdir, pbsnodes_pbspro_version)
+
+        resourcemanagers = []
+        for binary_changed in [False, False, True]:
+            if binary_changed:
+                with open(pbsnodes, "a") as f:
+                    f.write("exit 0\n")
+            tn = self.connect(nodes_cmd=pbsnodes)
+            tn.detect_resourcemanager()
+            resourcemanagers.append(tn.resourcemanager)
+
+        assert( resourcemanagers == ["pbspro", "pbspro", "pbspro"] )
+        # Detected on first use and again after the binary changed
+        assert( mock_popen.call_count == 2 )
+
+    @mock.patch('tracknodes.tracknodes.TrackNodes.which', return_value="sinfo")
+    def test_run_daemon(self, mock_which):
+        tn = self.new_tracknodes(nodes_cmd="sinfo", daemon=True, interval=0)
+        cycles = []
+
+        def mock_parse_nodes_cmd():
+            cycles.append(len(tn.current_failed))
+            tn.current_failed.append(("n%04d" % (len(cycles) % 2), 2, "bad DIMM"))
+            if len(cycles) == 3:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        tn.parse_nodes_cmd = mock_parse_nodes_cmd
+        orig_handler = signal.getsignal(signal.SIGTERM)
+        tn.run()
+
+        tn.cur.execute("SELECT COUNT(*) FROM NodeStates")
+        history = tn.cur.fetchone()[0]
+
+        # Failed nodes are reset every cycle, n0001 fails, n0000 fails and n0001 onlines, then the reverse
+        assert( cycles == [0, 0, 0] and history == 5 )
+        assert( signal.getsignal(signal.SIGTERM) == orig_handler and not tn.running )
+
+    def test_run_nodes_cmd_timeout(self):
+        # The command itself hangs, a wrapper waits on a child, or a wrapper exits leaving a child holding the output
+        for wrapper in ["exec sleep 30", "sleep 30", "sleep 30 &"]:
+            workdir = tempfile.mkdtemp(dir=self.tmpdir)
+            pbsnodes = os.path.join(workdir, "pbsnodes")
+            with open(pbsnodes, "w") as f:
+                f.write("#!/bin/sh\necho 'n0294 offline power fault'\n%s\n" % wrapper)
+            os.chmod(pbsnodes, 0o755)
+
+            tn = self.new_tracknodes(dbfile=os.path.join(workdir, "tracknodes.db"), nodes_cmd=pbsnodes, timeout=0.5)
+            tn.resourcemanager = "torque"
+            tn.connect_db()
+
+            orig_stderr = sys.stderr
+            sys.stderr = StringIO()
+            start = time.time()
+            updated = tn.update_cycle()
+            elapsed = time.time() - start
+            sys.stderr = orig_stderr
+
+            tn.cur.execute("SELECT Reason FROM FailedUpdates")
+            failed_updates = tn.cur.fetchall()
+            tn.cur.execute("SELECT COUNT(*) FROM NodeStates")
+            history = tn.cur.fetchone()[0]
+
+            assert( not updated and elapsed < 10 )
+            # The partial output was parsed but not written to the database
+            assert( tn.current_failed[0][0] == "n0294" and history == 0 )
+            assert( len(failed_updates) == 1 and "did not finish within 0.5 seconds" in failed_updates[0][0] )
+
+    def test_run_nodes_cmd_error(self):
+        sinfo = os.path.join(self.tmpdir, "sinfo")
+        with open(sinfo, "w") as f:
+            f.write("#!/bin/sh\necho 'REASON USER TIMESTAMP NODELIST'\necho 'Unable to contact slurm controller' >&2\nexit 1\n")
+        os.chmod(sinfo, 0o755)
+
+        tn = self.new_tracknodes(nodes_cmd=sinfo)
+        tn.resourcemanager = "slurm"
+        tn.connect_db()
+        tn.cur.execute("INSERT INTO CurrentFailedNodes(Name, State, Comment) VALUES('n010', 1, 'bad DIMM')")
+        tn.con.commit()
+        updated = tn.update_cycle()
+
+        tn.cur.execute("SELECT Reason FROM FailedUpdates")
+        failed_updates = tn.cur.fetchall()
+        tn.cur.execute("SELECT Name FROM CurrentFailedNodes")
+        current_failed = tn.cur.fetchall()
+
+        # Nodes are not marked online from the output of a failed command
+        assert( not updated and current_failed == [("n010",)] )
+        assert( len(failed_updates) == 1 and failed_updates[0][0].endswith("exited with status 1: Unable to contact slurm controller") )
+
+    def test_update_clusters(self):
+        results = []
+        # Several clusters are polled in parallel, a single cluster by its own collector
+        for clusters in [[("eagle", ["n010", "n011"]), ("swift", ["n010"])], [("swift", ["n010"])]]:
+            workdir = tempfile.mkdtemp(dir=self.tmpdir)
+            configfile = os.path.join(workdir, "tracknodes.conf")
+            with open(configfile, "w") as f:
+                f.write("---\nclusters:\n")
+                for (cluster, nodes) in clusters:
+                    os.mkdir(os.path.join(workdir, cluster))
+                    sinfo = os.path.join(workdir, cluster, "sinfo")
+                    with open(sinfo, "w") as s:
+                        s.write("#!/bin/sh\necho 'REASON USER TIMESTAMP NODELIST'\n")
+                        for node in nodes:
+                            s.write("echo '%s bad DIMM root 2017-01-02T09:09:02 %s'\n" % (cluster, node))
+                    os.chmod(sinfo, 0o755)
+                    f.write("  - name: %s\n    cmd: %s\n" % (cluster, sinfo))
+
+            tn = self.new_tracknodes(update=True, dbfile=os.path.join(workdir, "tracknodes.db"))
+            tn.parse_configfile(configs=[configfile])
+            tn.connect_db()
+            tn.find_clusters_cmds()
+            updated = tn.update_cycle()
+
+            tn.cur.execute("SELECT Cluster, Name, Comment FROM CurrentFailedNodes ORDER BY Cluster, Name")
+            current_failed = tn.cur.fetchall()
+            swift_history = list(tn.history(cluster="swift"))
+            results.append((updated, [collector.resourcemanager for collector in tn.clusters], current_failed, swift_history))
+
+        (updated, resourcemanagers, current_failed, swift_history) = results[0]
+        assert( updated and resourcemanagers == ["slurm", "slurm"] )
+        assert( current_failed == [("eagle", "n010", "eagle bad DIMM"), ("eagle", "n011", "eagle bad DIMM"),
+                                   ("swift", "n010", "swift bad DIMM")] )
+        assert( len(swift_history) == 1 and swift_history[0][4] == "swift" )
+        (updated, resourcemanagers, current_failed, swift_history) = results[1]
+        assert( updated and resourcemanagers == ["slurm"] and current_failed == [("swift", "n010", "swift bad DIMM")] )
+        assert( len(swift_history) == 1 and swift_history[0][4] == "swift" )
+
+    def test_write_metrics(self):
+        sinfo = os.path.join(self.tmpdir, "sinfo")
+        with open(sinfo, "w") as s:
+            s.write("#!/bin/sh\necho 'REASON USER TIMESTAMP NODELIST'\n")
+            s.write("echo 'bad DIMM root 2017-01-02T09:09:02 n010'\necho 'garbage'\n")
+        os.chmod(sinfo, 0o755)
+        metrics = os.path.join(self.tmpdir, "tracknodes.prom")
+
+        out = StringIO()
+        orig_stdout = sys.stdout
+        sys.stdout = out
+        tn = self.new_tracknodes(update=True, nodes_cmd=sinfo, metrics=metrics)
+        tn.run()
+        sys.stdout = orig_stdout
+        with open(metrics) as f:
+            prometheus = f.read()
+        # A query of the history leaves the metrics of the update
+        sys.stdout = out
+        self.new_tracknodes(metrics=metrics, node="n010").run()
+        sys.stdout = orig_stdout
+        with open(metrics) as f:
+            after_query = f.read()
+
+        tn.metrics_format = "json"
+        tn.update_cycle()
+        tn.write_metrics()
+        with open(metrics) as f:
+            data = json.load(f)
+
+        for phase in ["find_nodes_cmd", "nodes_cmd", "parse_nodes_cmd", "online_nodes", "fail_nodes", "commit", "print_history"]:
+            assert( 'tracknodes_phase_seconds{phase="%s"} ' % phase in prometheus )
+        assert( after_query == prometheus )
+        assert( "tracknodes_nodes_parsed 1\n" in prometheus and "tracknodes_parse_errors 1\n" in prometheus )
+        assert( "tracknodes_rows_written 1\n" in prometheus and "tracknodes_update_success 1\n" in prometheus )
+        assert( "find_nodes_cmd" not in data["phases"] and "commit" in data["phases"] )
+        assert( data["counts"]["rows_written"] == 0 and data["counts"]["nodes_failed"] == 1 )
+
+    def test_interned_history(self):
+        tn = self.connect(retention=1)
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)",
+                           [("n101", 1, "bad DIMM", 1000), ("n102", 1, "bad DIMM", 1500), ("n101", 0, "", 2000),
+                            ("n103", 2, "power fault", 2500)])
+        tn.con.commit()
+        tn.cur.execute("SELECT COUNT(*) FROM Nodes")
+        nodes = tn.cur.fetchone()[0]
+        tn.cur.execute("SELECT COUNT(*) FROM Comments")
+        comments = tn.cur.fetchone()[0]
+        history = list(tn.history(node="n10[12]"))
+        search = list(tn.search_comments("DIMM"))
+
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=TrackNodes.parse_time("1970-03-01")):
+            archived = tn.compact_history()
+        tn.cur.execute("SELECT COUNT(*) FROM Nodes")
+        nodes_after = tn.cur.fetchone()[0]
+        tn.cur.execute("SELECT COUNT(*) FROM Comments")
+        comments_after = tn.cur.fetchone()[0]
+
+        assert( nodes == 3 and comments == 3 )
+        assert( [(row[0], row[2], row[3]) for row in history] == [("n101", 0, ""), ("n102", 1, "bad DIMM"), ("n101", 1, "bad DIMM")] )
+        assert( sorted((row[0], row[1]) for row in search) == [("n101", 1), ("n102", 1)] )
+        # Names and comments only the archived history used are removed
+        assert( archived == 4 and nodes_after == 0 and comments_after == 0 )
+
+    def test_debounce_nodes(self):
+        tn = self.connect(debounce=2)
+        down = ("n101", 2, "power fault")
+        # n101 flaps for three updates then stays down, n102 fails for good, n103 is online for one update
+        cycles = [[down, ("n103", 1, "bad DIMM")], [("n103", 1, "bad DIMM")], [down, ("n102", 1, "bad DIMM"), ("n103", 1, "bad DIMM")],
+                  [down, ("n102", 1, "bad DIMM")], [down, ("n102", 1, "bad DIMM"), ("n103", 1, "bad DIMM")],
+                  [down, ("n102", 1, "bad DIMM"), ("n103", 1, "bad DIMM")], [down, ("n102", 1, "bad DIMM"), ("n103", 1, "bad DIMM")],
+                  [down, ("n102", 1, "bad DIMM"), ("n103", 1, "bad DIMM")]]
+        history = []
+        flaps = []
+        for (cycle, current_failed) in enumerate(cycles):
+            tn.current_failed = list(current_failed)
+            with mock.patch('tracknodes.tracknodes.time.time', return_value=1000 + cycle * 60):
+                tn.update_nodes()
+            tn.cur.execute("SELECT COUNT(*) FROM NodeStates")
+            history.append(tn.cur.fetchone()[0])
+            flaps.append(list(tn.flap_records()))
+        recorded = list(tn.history())
+
+        # Changes are recorded at the time first seen once they persisted for more than two updates, n103's recovery is a flap
+        assert( history == [0, 0, 1, 1, 3, 3, 3, 3] )
+        assert( sorted((row[0], row[1], row[2]) for row in recorded) == [("n101", "1970-01-01 00:18:40", 2), ("n102", "1970-01-01 00:18:40", 1),
+                                                                         ("n103", "1970-01-01 00:16:40", 1)] )
+        assert( flaps[0] == [] and flaps[1] == [("n101", 1000, 1060, None, 1, 2, "power fault", "")] )
+        assert( [flap[0:5] for flap in flaps[4]] == [("n103", 1180, 1240, None, 1), ("n101", 1000, 1060, None, 1)] )
+        # Closed once quiet for more than two updates
+        assert( flaps[5][1][3] is None and flaps[6][1][3] == 1060 and flaps[6][0][3] is None and flaps[7][0][3] == 1240 )
+
+    def test_node_summaries(self):
+        tn = self.connect()
+        insert = "INSERT INTO NodeStates(Name, State, Comment, Time, Cluster) VALUES(?, ?, ?, ?, ?)"
+        tn.cur.executemany(insert, [("n102", 2, "power fault", 1477000000, ""), ("n101", 1, "bad DIMM", 1478000000, ""),
+                                    ("n101", 0, "", 1478100000, "")])
+        with tn.con:
+            first = tn.refresh_summary()
+        tn.cur.executemany(insert, [("n103", 1, "bad DIMM", 1478050000, "swift"), ("n101", 2, "power fault", 1478200000, ""),
+                                    ("n101", 3, "power fault again", 1478300000, ""), ("n103", 0, "", 1478060000, "swift")])
+        tn.con.commit()
+
+        out = StringIO()
+        orig_stdout = sys.stdout
+        sys.stdout = out
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=1478400000):
+            # Served read-only, the rows not in the cache yet are folded in memory
+            self.new_tracknodes(summary=True).run()
+            merged = list(tn.node_summaries())
+            with tn.con:
+                second = tn.refresh_summary()
+                third = tn.refresh_summary()
+            cached = list(tn.node_summaries())
+            filtered = list(tn.node_summaries(node="n10[23]", state="online"))
+        sys.stdout = orig_stdout
+        last_id = tn.get_metadata("summary_last_id")
+
+        assert( (first, second, third) == (2, 2, 0) and int(last_id) == 7 )
+        assert( merged == cached )
+        assert( cached == [("n101", 3, "power fault again", 1478200000, 2, ""), ("n102", 2, "power fault", 1477000000, 0, ""),
+                           ("n103", 0, "", 1478060000, 1, "swift")] )
+        assert( filtered == [("n103", 0, "", 1478060000, 1, "swift")] )
+        lines = out.getvalue().splitlines()
+        assert( lines[2] == "n101 | offline,down | since 2016-11-03 19:06:40 | 2 failures this month | 'power fault again'" )
+        assert( lines[-1] == "2 failed nodes, 3 failures this month" )
+
+    def test_node_summaries_after_compaction(self):
+        tn = self.connect(retention=1)
+        # The third update archives the whole history, the fourth brings n2 back
+        cycles = [("2016-10-01", [("n1", 2, "power fault"), ("n2", 2, "power fault")]), ("2016-10-02", [("n2", 2, "power fault")]),
+                  ("2017-01-15", [("n2", 2, "power fault")]), ("2017-01-16", [])]
+        with mock.patch.object(TrackNodes, "collect", return_value=None):
+            for (day, current_failed) in cycles:
+                tn.current_failed = current_failed
+                with mock.patch('tracknodes.tracknodes.time.time', return_value=TrackNodes.parse_time(day)):
+                    tn.update_cycle()
+        tn.cur.execute("SELECT COUNT(*) FROM NodeStatesArchive")
+        archives = tn.cur.fetchone()[0]
+        tn.cur.execute("SELECT COUNT(*) FROM CurrentFailedNodes")
+        current_failed = tn.cur.fetchone()[0]
+        summaries = list(tn.node_summaries())
+
+        assert( archives == 1 and current_failed == 0 )
+        assert( [summary[0:4] for summary in summaries] == [("n1", 0, "", TrackNodes.parse_time("2016-10-02")),
+                                                            ("n2", 0, "", TrackNodes.parse_time("2017-01-16"))] )
+
+    def test_node_changes(self):
+        tn = self.connect()
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time, Cluster) VALUES(?, ?, ?, ?, ?)",
+                           [("n101", 1, "bad DIMM", 1000, ""), ("n102", 2, "power fault", 1500, ""),
+                            ("n101", 0, "", 2000, ""), ("n103", 1, "bad DIMM", 2500, "swift")])
+        tn.con.commit()
+
+        first = list(tn.node_changes(limit=2))
+        rest = list(tn.node_changes(cursor=first[-1][0]))
+        since = list(tn.node_changes(since="1970-01-01 00:33:20"))
+        swift = list(tn.node_changes(cursor=0, cluster="swift"))
+        latest = tn.latest_cursor()
+
+        out = StringIO()
+        orig_stdout = sys.stdout
+        sys.stdout = out
+        self.new_tracknodes(changes="2", node="n102").run()
+        self.new_tracknodes(changes="0", limit=1).run()
+        sys.stdout = orig_stdout
+
+        assert( [change[1] for change in first] == ["n101", "n102"] and [change[1] for change in rest] == ["n101", "n103"] )
+        assert( first[0] == (1, "n101", 1000, 1, "bad DIMM", "") and rest[-1][0] == latest == 4 )
+        assert( [change[0] for change in since] == [3, 4] and [change[1] for change in swift] == ["n103"] )
+        lines = out.getvalue().splitlines()
+        assert( lines[2] == "" and lines[3] == "cursor: 4" )
+        assert( lines[6] == "1 | n101 | 1970-01-01 00:16:40 | offline | 'bad DIMM'" and lines[8] == "cursor: 1" )
+
+    def test_export_rows(self):
+        tn = self.connect()
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time, Cluster) VALUES(?, ?, ?, ?, ?)",
+                           [("n101", 1, "bad DIMM, again", 1000, ""), ("n102", 2, "power fault", 1500, ""),
+                            ("n101", 0, "", 2000, "")])
+        tn.cur.execute("INSERT INTO CurrentFailedNodes(Name, State, Comment, Cluster) VALUES('n102', 2, 'power fault', '')")
+        tn.con.commit()
+
+        csv_out = StringIO()
+        with mock.patch('tracknodes.tracknodes.HISTORY_BATCH_SIZE', 1):
+            exporter = self.new_tracknodes(export="csv", node="n101")
+            exporter.connect_db(readonly=True)
+            exporter.export_rows(csv_out)
+        jsonl_out = StringIO()
+        current = self.new_tracknodes(export="jsonl", current=True)
+        current.connect_db(readonly=True)
+        current.export_rows(jsonl_out)
+
+        assert( csv_out.getvalue().splitlines() == ["cluster,node,time,state,comment",
+                                                    ",n101,1970-01-01 00:33:20,online,",
+                                                    ',n101,1970-01-01 00:16:40,offline,"bad DIMM, again"'] )
+        assert( jsonl_out.getvalue() == '{"cluster": "", "comment": "power fault", "node": "n102", "state": "down"}\n' )
+
+    def test_downtimes(self):
+        with mock.patch('tracknodes.tracknodes.SCHEMA_VERSION', 5):
+            tn = self.connect()
+            tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)",
+                               [("n101", 1, "bad DIMM", 1000), ("n101", 3, "DIMM replaced", 1500), ("n101", 0, "", 2000),
+                                ("n102", 2, "power fault", 1800), ("n101", 1, "bad DIMM again", 5000)])
+            tn.cur.executemany("INSERT INTO CurrentFailedNodes(Name, State, Comment) VALUES(?, ?, ?)",
+                               [("n102", 2, "power fault"), ("n101", 1, "bad DIMM again")])
+            tn.con.commit()
+            tn.con.close()
+            tn.con = None
+
+        # Backfilled from the history when migrating
+        tn = self.connect()
+        backfilled = sorted(tn.downtimes(), key=lambda downtime: downtime[1])
+        in_range = tn.downtime_seconds(since=1200, until=6000)
+
+        # Maintained by the update path
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=7000):
+            tn.current_failed = [("n102", 2, "power fault"), ("n103", 128, "")]
+            tn.update_nodes()
+        updated = sorted(tn.downtimes(since=6500), key=lambda downtime: downtime[1])
+
+        assert( backfilled == [("n101", 1000, 2000, 3, "DIMM replaced", ""), ("n102", 1800, None, 2, "power fault", ""),
+                               ("n101", 5000, None, 1, "bad DIMM again", "")] )
+        assert( in_range["n101"] == 800 + 1000 and in_range["n102"] == 6000 - 1800 )
+        assert( updated == [("n102", 1800, None, 2, "power fault", ""), ("n101", 5000, 7000, 1, "bad DIMM again", ""),
+                            ("n103", 7000, None, 128, "", "")] )
+
+    def test_availability(self):
+        tn = self.connect()
+        tn.cur.executemany("INSERT INTO Downtimes VALUES('', ?, ?, ?, ?, ?)",
+                           [("n101", 3, "bad DIMM", 0, 1000), ("n101", 1, "bad DIMM", 5000, 5500), ("n101", 2, "", 9500, None),
+                            ("n102", 2, "power fault", 2000, 3000), ("n103", 1, "", -5000, -4000)])
+        tn.con.commit()
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=10000):
+            stats = tn.availability(since=0, until=20000)
+
+        # Window is clipped to now, n101 was down 1000 + 500 + 500 seconds in 3 outages
+        assert( stats["until"] == 10000 and stats["nodes_total"] == 3 and stats["nodes_failed"] == 2 )
+        assert( stats["outages"] == 4 and stats["downtime"] == 3000 and stats["availability"] == 90.0 )
+        assert( stats["nodes"][0] == {"name": "n101", "outages": 3, "downtime": 2000, "availability": 80.0,
+                                      "mtbf": 8000 // 3, "mttr": 2000 // 3} )
+        assert( [(state["state"], state["outages"], state["downtime"]) for state in stats["states"]] ==
+                [("offline", 2, 1500), ("down", 3, 2500)] )
+
+    def test_search_comments(self):
+        with mock.patch('tracknodes.tracknodes.SCHEMA_VERSION', 7):
+            tn = self.connect()
+            tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)",
+                               [("n101", 1, "bad DIMM", 1000), ("n101", 0, "", 2000), ("n102", 2, "power-fault", 3000)])
+            tn.con.commit()
+            tn.con.close()
+            tn.con = None
+
+        # Existing comments are indexed when migrating, new ones by the update path
+        tn = self.connect()
+        tn.current_failed = [("n101", 1, "DIMM replaced, still bad dimm"), ("n103", 1, "dimm errors")]
+        tn.update_nodes()
+
+        dimm = list(tn.search_comments("dimm"))
+        power = list(tn.search_comments("power-fault"))
+        since = list(tn.search_comments("DIMM", since=1500))
+        tn.cur.execute("DELETE FROM NodeStates WHERE Name='n103'")
+        deleted = list(tn.search_comments("DIMM", node="n103"))
+
+        assert( [(row[0], row[1], row[3]) for row in dimm] == [("n101", 2, "DIMM replaced, still bad dimm"), ("n103", 1, "dimm errors")] )
+        assert( [(row[0], row[1]) for row in power] == [("n102", 1)] )
+        assert( sorted((row[0], row[1]) for row in since) == [("n101", 1), ("n103", 1)] )
+        assert( deleted == [] )
+
+    def test_compact_history(self):
+        tn = self.connect(retention=1)
+        # One entry a day from 2016-10-01 to 2016-12-30
+        rows = [("n%03d" % (day % 7), day % 2, "bad DIMM %d" % day, 1475280000 + day * 86400) for day in range(91)]
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)", rows)
+        tn.con.commit()
+
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=TrackNodes.parse_time("2016-12-31")):
+            archived = tn.compact_history()
+            archived_again = tn.compact_history()
+
+        tn.cur.execute("SELECT Month, Rows FROM NodeStatesArchive ORDER BY Month")
+        months = tn.cur.fetchall()
+        tn.cur.execute("SELECT datetime(MIN(Time), 'unixepoch'), COUNT(*) FROM NodeStates")
+        remaining = tn.cur.fetchone()
+        tn.cur.execute("PRAGMA auto_vacuum")
+        auto_vacuum = tn.cur.fetchone()[0]
+
+        everything = list(tn.history(archive=True))
+        live = list(tn.history())
+        limited = list(tn.history(node="n003", state="offline", since="2016-10-15", limit=6, archive=True))
+        search = list(tn.search_comments("DIMM 5"))
+        search_live = list(tn.search_comments("DIMM 40"))
+
+        # The current and the previous month are kept
+        assert( archived == 31 and archived_again == 0 and auto_vacuum == 2 )
+        assert( months == [("2016-10", 31)] and remaining == ("2016-11-01 00:00:00", 60) )
+        assert( len(live) == 60 and [row[1] for row in everything] == [TrackNodes.format_time(row[3]) for row in reversed(rows)] )
+        assert( [row[1][0:10] for row in limited] == ["2016-12-27", "2016-12-13", "2016-11-29", "2016-11-15", "2016-11-01", "2016-10-18"] )
+        # Archived comments are no longer indexed
+        assert( search == [] and len(search_live) == 1 )
+
+    def test_history_ids_after_compaction(self):
+        tn = self.connect(retention=1)
+        insert = "INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)"
+        tn.cur.executemany(insert, [("n1", 2, "power fault", 1475280000), ("n2", 2, "power fault", 1475366400),
+                                    ("n1", 0, "", 1475452800)])
+        tn.con.commit()
+        cursor = tn.latest_cursor()
+
+        # The whole history is archived, the next change must still come after the cursor
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=TrackNodes.parse_time("2017-01-15")):
+            archived = tn.compact_history()
+        archived_cursor = tn.latest_cursor()
+        tn.cur.execute(insert, ("n3", 1, "bad DIMM", 1484438400))
+        tn.con.commit()
+        changes = list(tn.node_changes(cursor=cursor))
+
+        # Upgraded databases continue after ids the summary cache already refers to
+        tn.cur.execute("INSERT OR REPLACE INTO Metadata VALUES('summary_last_id', '10')")
+        with tn.con:
+            tn.migrate_16()
+        tn.cur.execute(insert, ("n3", 0, "", 1484524800))
+        tn.con.commit()
+        upgraded = list(tn.node_changes(cursor=4))
+
+        assert( cursor == 3 and archived == 3 and archived_cursor == 3 )
+        assert( [change[0:2] for change in changes] == [(4, "n3")] )
+        assert( [change[0:2] for change in upgraded] == [(11, "n3")] )
+
+    def test_migrate_16_failed(self):
+        with mock.patch('tracknodes.tracknodes.SCHEMA_VERSION', 15):
+            tn = self.connect()
+            tn.cur.execute("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES('n101', 2, 'power fault', 1480365001)")
+            tn.con.commit()
+            tn.con.close()
+
+        # Fails after the view was dropped and the history copied
+        tn = self.new_tracknodes()
+        with mock.patch.object(TrackNodes, "create_node_states_view", side_effect=Exception("disk full")):
+            self.assertRaises(Exception, tn.connect_db)
+        failed_version = tn.schema_version()
+        failed_rows = list(tn.history())
+        tn.con.close()
+
+        tn = self.connect()
+        version = tn.schema_version()
+        rows = list(tn.history())
+
+        assert( failed_version == 15 and [row[0] for row in failed_rows] == ["n101"] )
+        assert( version == tracknodes.tracknodes.SCHEMA_VERSION and [row[0] for row in rows] == ["n101"] )
+
+    def test_archive_blocks(self):
+        # An archive of October written whole by schema 16
+        october = [[day + 1, "n%03d" % day, 1, "bad DIMM", 1475280000 + day * 86400, ""] for day in range(10)]
+        with mock.patch('tracknodes.tracknodes.SCHEMA_VERSION', 16):
+            tn = self.connect()
+            data = sqlite3.Binary(zlib.compress("\n".join(json.dumps(row) for row in october).encode("utf-8")))
+            tn.cur.execute("INSERT INTO NodeStatesArchive VALUES('2016-10', 1475280000, 1477958400, 10, ?)", (data,))
+            tn.cur.execute("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES('n100', 2, 'power fault', 1476000000)")
+            tn.con.commit()
+            tn.con.close()
+
+        with mock.patch('tracknodes.tracknodes.HISTORY_BATCH_SIZE', 4):
+            tn = self.connect(retention=1)
+            # A late October entry is appended to the archived month
+            with mock.patch('tracknodes.tracknodes.time.time', return_value=TrackNodes.parse_time("2016-12-15")):
+                archived = tn.compact_history()
+            tn.cur.execute("SELECT Block, Rows FROM NodeStatesArchiveBlocks ORDER BY Block")
+            blocks = tn.cur.fetchall()
+            tn.cur.execute("SELECT Rows FROM NodeStatesArchive")
+            rows = tn.cur.fetchall()
+            history = list(tn.history(archive=True))
+            limited = list(tn.history(archive=True, limit=2))
+            failed = tn.failed_nodes_at("2016-10-08")
+
+        assert( archived == 1 and blocks == [(0, 4), (1, 4), (2, 2), (3, 1)] and rows == [(11,)] )
+        assert( [row[0] for row in history] == ["n100"] + ["n%03d" % day for day in reversed(range(10))] )
+        assert( [row[0] for row in limited] == ["n100", "n009"] and [row[0] for row in failed] == ["n%03d" % day for day in range(8)] )
+
+    def test_failed_nodes_at(self):
+        tn = self.connect(retention=1)
+        # One entry a day from 2016-10-01 to 2016-12-30, each node alternates between failed and online
+        rows = [("n%03d" % (day % 7), day % 2, "bad DIMM %d" % day, 1475280000 + day * 86400) for day in range(91)]
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)", rows[:40])
+        tn.cur.executemany("INSERT INTO CurrentFailedNodes(Name, State, Comment) VALUES(?, ?, ?)",
+                           [(name, state, comment) for (name, state, comment, nodetime) in rows[33:40] if state])
+        tn.con.commit()
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=rows[39][3]):
+            checkpointed = tn.checkpoint_failed_nodes()
+            checkpointed_again = tn.checkpoint_failed_nodes()
+        tn.cur.executemany("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES(?, ?, ?, ?)", rows[40:])
+        tn.con.commit()
+
+        def replay(at):
+            failed = {}
+            for (name, state, comment, nodetime) in rows:
+                if nodetime <= at:
+                    failed[name] = (state, comment)
+            return [(name, state, comment, "") for (name, (state, comment)) in sorted(failed.items()) if state]
+
+        times = [rows[10][3], rows[39][3], rows[45][3] - 1, rows[60][3], TrackNodes.parse_time("2016-11-05")]
+        before = [tn.failed_nodes_at(at) for at in times]
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=TrackNodes.parse_time("2016-12-31")):
+            tn.compact_history()
+        tn.cur.execute("SELECT datetime(Time, 'unixepoch') FROM FailedNodesCheckpoints")
+        checkpoints = tn.cur.fetchall()
+        # Times in the archived month are replayed from the archive
+        after = [tn.failed_nodes_at(at) for at in times]
+        filtered = tn.failed_nodes_at(rows[60][3], node="n00[0-3]", state="offline")
+        # Archiving November keeps a checkpoint at the end of each archived month
+        with mock.patch('tracknodes.tracknodes.time.time', return_value=TrackNodes.parse_time("2017-01-31")):
+            tn.compact_history()
+        tn.cur.execute("SELECT datetime(Time, 'unixepoch') FROM FailedNodesCheckpoints ORDER BY Time")
+        month_checkpoints = tn.cur.fetchall()
+        archived = [tn.failed_nodes_at(at) for at in times]
+
+        assert( checkpointed and not checkpointed_again )
+        assert( before == [replay(at) for at in times] and after == [replay(at) for at in times] and after[0] )
+        assert( checkpoints == [("2016-10-31 23:59:59",), ("2016-11-09 00:00:00",)] )
+        assert( filtered == [row for row in replay(rows[60][3]) if row[0] <= "n003"] and len(filtered) == 2 )
+        assert( month_checkpoints == [("2016-10-31 23:59:59",), ("2016-11-30 23:59:59",)] and archived == after )
+
+    def test_readonly_user(self):
+        # A database switched to WAL by an earlier update goes back to rollback journal mode
+        for wal in [True, None]:
+            tn = self.connect(wal=wal)
+            tn.cur.execute("INSERT INTO NodeStates(Name, State, Comment, Time) VALUES('n101', 2, 'power fault', 1480365001)")
+            tn.con.commit()
+            tn.con.close()
+        os.chmod(self.tmpdir, 0o755)
+        os.chmod(self.dbfile, 0o644)
+
+        def drop_privileges():
+            if os.getuid() == 0:
+                import pwd
+                os.setgid(pwd.getpwnam("nobody").pw_gid)
+                os.setuid(pwd.getpwnam("nobody").pw_uid)
+        if os.getuid() != 0:
+            os.chmod(self.tmpdir, 0o555)
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(tracknodes.tracknodes.__file__))))
+        script = "from tracknodes.tracknodes import TrackNodes; TrackNodes(dbfile=%r).run()" % self.dbfile
+        proc = subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                                preexec_fn=drop_privileges, universal_newlines=True)
+        output = proc.communicate()[0]
+        os.chmod(self.tmpdir, 0o755)
+
+        # Queries never migrate, an old schema is left to the update
+        olddb = os.path.join(self.tmpdir, "old.db")
+        con = sqlite3.connect(olddb)
+        con.execute("CREATE TABLE NodeStates(Name TEXT, State INT, Comment TEXT, Time TEXT)")
+        con.commit()
+        con.close()
+        self.assertRaises(Exception, self.new_tracknodes(dbfile=olddb).run)
+        con = sqlite3.connect(olddb)
+        tables = con.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()
+        con.close()
+
+        assert( proc.returncode == 0 and "n101 | 2016-11-28 20:30:01 | down | 'power fault'" in output )
+        assert( tables == [("NodeStates",)] )
+
+    @mock.patch('tracknodes.tracknodes.TrackNodes.which', return_value="sinfo")
+    def test_update_lock(self, mock_which):
+        collector = self.connect(busy_timeout=2.5, wal=True)
+        locked = collector.lock_updates()
+        collector.cur.execute("PRAGMA journal_mode")
+        journal_mode = collector.cur.fetchone()[0]
+        collector.cur.execute("PRAGMA busy_timeout")
+        busy_timeout = collector.cur.fetchone()[0]
+
+        out = StringIO()
+        orig_stdout = sys.stdout
+        orig_stderr = sys.stderr
+        sys.stdout = out
+        sys.stderr = StringIO()
+
+        overlapping = self.new_tracknodes(update=True, nodes_cmd="sinfo")
+        overlapping.parse_nodes_cmd = mock.Mock()
+        overlapping.run()
+        skipped = sys.stderr.getvalue()
+
+        sys.stdout = orig_stdout
+        sys.stderr = orig_stderr
+
+        collector.unlock_updates()
+        relocked = overlapping.lock_updates()
+        overlapping.unlock_updates()
+
+        assert( locked and journal_mode == "wal" and busy_timeout == 2500 )
+        assert( "skipping update" in skipped and not overlapping.parse_nodes_cmd.called and "History of Nodes" in out.getvalue() )
+        assert( relocked )